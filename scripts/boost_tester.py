@@ -0,0 +1,86 @@
+"""
+The point of this script is to validate the vectorised boost kernels in lorentz_kernels.py
+against the one-event-at-a-time implementation in StandaloneReweight (allboost, zboost,
+rotZ and rotY), which BoostToCOM still uses for single events. No matrix element library
+is needed.
+
+Random events are generated with and without transverse momentum in the initial state,
+then boosted into the partonic centre-of-mass frame with both implementations. The
+script prints the largest relative difference and the fraction of events that disagree
+by more than the threshold (1e-9 by default).
+
+To run do:
+  python scripts/boost_tester.py <NEVENTS> <NPARTICLES> <VERB>
+<VERB> = 0 -> Minimal output
+<VERB> = 1 -> Prints out events that fail
+"""
+from __future__ import print_function
+
+import sys
+import numpy as np
+from standalone_reweight import StandaloneReweight
+
+
+def randomEvents(n_events, n_parts, n_inits, rng):
+  """Massive final-state particles with incoming partons that balance them, optionally with ISR pT"""
+  n_fnal = n_parts - n_inits
+  fnal = np.zeros((n_events, n_fnal, 4))
+  fnal[:, :, 1:] = rng.normal(scale=100., size=(n_events, n_fnal, 3))
+  masses = rng.uniform(0., 150., size=(n_events, n_fnal))
+  fnal[:, :, 0] = np.sqrt(masses**2 + (fnal[:, :, 1:]**2).sum(axis=2))
+  ptot = fnal.sum(axis=1)
+
+  inits = np.zeros((n_events, n_inits, 4))
+  if n_inits == 1:
+    inits[:, 0] = ptot
+  else:
+    x = rng.uniform(0.2, 0.8, size=n_events)
+    inits[:, 0, 0] = x * (ptot[:, 0] + ptot[:, 3])
+    inits[:, 0, 3] = inits[:, 0, 0]
+    inits[:, 1] = ptot - inits[:, 0]
+    # Remove the transverse momentum from half of the events so the pure z boost is also tested
+    no_pt = rng.uniform(size=n_events) < 0.5
+    inits[no_pt, :, 1:3] = 0.
+  return np.concatenate((inits, fnal), axis=1)
+
+if __name__=="__main__":
+  try:
+    n_events = int(sys.argv[1])
+  except:
+    n_events = 10000
+  try:
+    n_parts = int(sys.argv[2])
+  except:
+    n_parts = 6
+  try:
+    VERB = int(sys.argv[3])
+  except:
+    VERB = 0
+  threshold = 1e-9
+
+  rng = np.random.default_rng(1234)
+  # Only the boost methods are used, so no rw pack needs to be loaded
+  rw = StandaloneReweight.__new__(StandaloneReweight)
+
+  for n_inits in [2, 1]:
+    rw.nInits = n_inits
+    parts = randomEvents(n_events, n_parts, n_inits, rng)
+    vectorised = rw.BoostToCOM(parts)
+
+    no_failed = 0
+    max_diff = 0.
+    for i in range(n_events):
+      scalar = rw.BoostToCOM(parts[i])
+      diff = np.max(np.abs(vectorised[i] - scalar)) / np.max(np.abs(scalar[:, 0]))
+      max_diff = max(max_diff, diff)
+      # The zero-snapping must agree exactly
+      passed = diff < threshold and np.array_equal(vectorised[i] == 0, scalar == 0)
+      if not passed:
+        no_failed += 1
+        if VERB >= 1:
+          print("Input:\n%s" % parts[i])
+          print("Scalar:\n%s" % scalar)
+          print("Vectorised:\n%s\n" % vectorised[i])
+
+    print("nInits=%i: max relative difference: %g" % (n_inits, max_diff))
+    print("nInits=%i: fraction failed: %f" % (n_inits, float(no_failed) / float(n_events)))
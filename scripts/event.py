@@ -35,7 +35,7 @@ class Particle(object):
   def __str__(self):
     p_strs = [("%.1f"%p_i).rjust(10, ' ') for p_i in self.p]
 
-    string = str(pdg_dict[self.pdg_id]).rjust(10, ' ') + str(self.status).rjust(10, ' ') + str(self.helicity).rjust(10, ' ') + " "*5 + ''.join(p_strs)
+    string = str(getPdgDict()[self.pdg_id]).rjust(10, ' ') + str(self.status).rjust(10, ' ') + str(self.helicity).rjust(10, ' ') + " "*5 + ''.join(p_strs)
 
     return string
 
@@ -92,15 +92,161 @@ class Event(object):
       strings.append(str(particle))
     return "\n".join(strings)
 
+class EventBatch(object):
+  """
+  A batch of events held in contiguous numpy arrays instead of one object per particle.
+  The particles of event i are the entries offsets[i]:offsets[i+1] of p (momenta in
+  [E, px, py, pz] format), pdg_ids, statuses and helicities. helicities can be None if
+  they are not known.
+  """
+  def __init__(self, event_ids, weights, p, pdg_ids, statuses, helicities, offsets, alphas=0.137, scale2=0.0):
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    n_events = len(self.offsets) - 1
+    self.event_ids = np.asarray(event_ids, dtype=np.int64)
+    self.weights = np.broadcast_to(np.asarray(weights, dtype=np.float64), (n_events,))
+    self.p = np.ascontiguousarray(p, dtype=np.float64).reshape(-1, 4)
+    self.pdg_ids = np.asarray(pdg_ids, dtype=np.int64)
+    self.statuses = np.asarray(statuses, dtype=np.int64)
+    self.helicities = None if helicities is None else np.asarray(helicities, dtype=np.int64)
+    self.alphas = np.broadcast_to(np.asarray(alphas, dtype=np.float64), (n_events,))
+    self.scale2 = np.broadcast_to(np.asarray(scale2, dtype=np.float64), (n_events,))
+
+  @classmethod
+  def fromEvents(cls, events):
+    """Build a batch from a list of Event objects"""
+    parts = [particle for event in events for particle in event.getParticles()]
+    helicities = [particle.getHelicity() for particle in parts]
+    return cls([event.event_id for event in events],
+               [event.getWeight() for event in events],
+               np.reshape([particle.getP() for particle in parts], (-1, 4)),
+               [particle.getPdg_id() for particle in parts],
+               [particle.getStatus() for particle in parts],
+               None if None in helicities else helicities,
+               np.cumsum([0] + [len(event.getParticles()) for event in events]),
+               [event.alphas for event in events],
+               [event.scale2 for event in events])
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if i < 0 or i >= len(self):
+      raise IndexError("Event %i is out of range for a batch of %i events" % (i, len(self)))
+    return BatchEvent(self, i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield BatchEvent(self, i)
+
+  def getNParticles(self):
+    return np.diff(self.offsets)
+
+  def getReweightInfo(self):
+    """
+    The momenta (nevents, nparticles, 4), pdg ids, helicities and statuses (nevents,
+    nparticles), where nparticles is the largest number of particles of any event.
+    Events with fewer particles are padded with entries of status 0, as accepted by
+    StandaloneReweight.ComputeWeightsBatch.
+    """
+    n_parts = self.getNParticles()
+    n_max = int(n_parts.max()) if len(self) > 0 else 0
+    rows = np.repeat(np.arange(len(self)), n_parts)
+    cols = np.arange(len(self.p)) - np.repeat(self.offsets[:-1], n_parts)
+
+    parts = np.zeros((len(self), n_max, 4))
+    pdgs = np.zeros((len(self), n_max), dtype=np.int64)
+    helicities = np.zeros((len(self), n_max), dtype=np.int64)
+    status = np.zeros((len(self), n_max), dtype=np.int64)
+    parts[rows, cols] = self.p
+    pdgs[rows, cols] = self.pdg_ids
+    if self.helicities is not None:
+      helicities[rows, cols] = self.helicities
+    status[rows, cols] = self.statuses
+    return parts, pdgs, helicities, status
+
+  def getReweights(self, rw):
+    parts, pdgs, helicities, status = self.getReweightInfo()
+
+    reweights = rw.ComputeWeightsBatch(parts, pdgs, helicities, status, self.alphas, self.helicities is not None, VERB)
+    return reweights
+
+class BatchEvent(Event):
+  """
+  View of one event of an EventBatch. The Particle objects are only made when they are
+  needed, e.g. to print the event.
+  """
+  def __init__(self, batch, i):
+    self.batch = batch
+    self.index = i
+    self.particle_slice = slice(batch.offsets[i], batch.offsets[i+1])
+    self.event_id = int(batch.event_ids[i])
+    self.alphas = float(batch.alphas[i])
+    self.weight = float(batch.weights[i])
+    self.scale2 = float(batch.scale2[i])
+
+  @property
+  def gen_particles(self):
+    parts, pdgs, helicities, status = self.getReweightInfo()
+    return [Particle(*args) for args in zip(parts, pdgs, status, helicities)]
+
+  def getReweightInfo(self):
+    s = self.particle_slice
+    helicities = [None] * (s.stop - s.start) if self.batch.helicities is None else self.batch.helicities[s].tolist()
+    return self.batch.p[s].tolist(), self.batch.pdg_ids[s].tolist(), helicities, self.batch.statuses[s].tolist()
+
 """
 Credit to https://github.com/scikit-hep/particle for the csv file
 https://doi.org/10.5281/zenodo.2552429
 """
+import os
 import csv
-pdg_dict = {}
-with open("pdgid_to_evtgenname.csv", "r") as f:
-  line_no = 0
-  for row in csv.reader(f):
-    if line_no>1:
-      pdg_dict[int(row[0])] = row[1]
-    line_no += 1
+import pickle
+
+PDG_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "pdgid_to_evtgenname.csv")
+PDG_CACHE = os.path.splitext(PDG_CSV)[0] + ".pkl"
+_pdg_dict = None
+
+def readPdgCsv(filename):
+  pdg_dict = {}
+  with open(filename, "r") as f:
+    line_no = 0
+    for row in csv.reader(f):
+      if line_no>1:
+        pdg_dict[int(row[0])] = row[1]
+      line_no += 1
+  return pdg_dict
+
+def getPdgDict():
+  """
+  The particle names by PDG id. Only read when first needed, from a pickle cache next to
+  the csv file if it is newer than the csv, otherwise from the csv (and the cache is then
+  written for other processes, if the directory is writable).
+  """
+  global _pdg_dict
+  if _pdg_dict is not None:
+    return _pdg_dict
+  try:
+    if os.path.getmtime(PDG_CACHE) >= os.path.getmtime(PDG_CSV):
+      with open(PDG_CACHE, "rb") as f:
+        _pdg_dict = pickle.load(f)
+      return _pdg_dict
+  except (IOError, OSError, EOFError, pickle.UnpicklingError):
+    pass
+  _pdg_dict = readPdgCsv(PDG_CSV)
+  tmp = "%s.%i.tmp" % (PDG_CACHE, os.getpid())
+  try:
+    with open(tmp, "wb") as f:
+      pickle.dump(_pdg_dict, f, protocol=2)
+    os.rename(tmp, PDG_CACHE)
+  except (IOError, OSError):
+    if os.path.exists(tmp):
+      os.remove(tmp)
+  return _pdg_dict
+
+def __getattr__(name):
+  # pdg_dict is still available as an attribute of the module, but only built when used
+  if name == "pdg_dict":
+    return getPdgDict()
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,22 @@
+"""
+Merge a weight file written by standalone_reweight.py with --format npz back into the
+original LHE file. The output is the same as running standalone_reweight.py with the
+default LHE output.
+
+To run do:
+  python scripts/join_weights.py -i input.lhe -w weights.npz -o output.lhe
+"""
+from __future__ import print_function
+
+import argparse
+import lhe_stream
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-i', '--input', required=True, help="LHE file that was reweighted")
+  parser.add_argument('-w', '--weights', required=True, help="npz weight file")
+  parser.add_argument('-o', '--output', required=True, help="Output LHE file (.lhe or .lhe.gz)")
+  args = parser.parse_args()
+
+  neve = lhe_stream.JoinWeights(args.input, args.weights, args.output)
+  print('>> Wrote %i events to %s' % (neve, args.output))
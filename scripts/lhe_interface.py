@@ -4,6 +4,10 @@ Can be used interactively to search through an lhe file by doing:
   python scripts/lhe_interface.py my_lhe_file.lhe
 If you want to also see the reweights in the lhe file do:
   python scripts/lhe_interface.py my_lhe_file.lhe <number of reweights>
+To start browsing from a given event (counting from 0) do:
+  python scripts/lhe_interface.py my_lhe_file.lhe <number of reweights> <first event>
+Jumping to an event uses the event index of lhe_stream.py, which is built on first use and
+saved next to the file.
 """
 from __future__ import print_function
 
@@ -11,70 +15,114 @@ from builtins import input
 from builtins import str
 from builtins import next
 from builtins import range
-import ROOT
 from event import *
 import numpy as np
+import lhe_stream
 
-ROOT.gROOT.ProcessLine('#include "LHEF.h"')
+def openEvents(filename, start=0, stop=None):
+  """Iterate over the lhe_stream.LHEEvent objects of events start to stop - 1"""
+  reader = lhe_stream.LHEReader(filename)
+  if start == 0 and stop is None:
+    return iter(reader)
+  return reader.Events(start, len(reader) if stop is None else stop)
 
-def getEvents(filename):  
+def makeEvent(event_id, lhe_event):
+  parts = []
+  for p, pdg, status, helicity in zip(lhe_event.parts.tolist(), lhe_event.pdgs.tolist(), lhe_event.stats.tolist(), lhe_event.hels.tolist()):
+    parts.append(Particle(p, pdg, status, helicity))
+  return Event(event_id, lhe_event.xwgtup, parts, lhe_event.aqcdup, 0.0)
+
+def getReweights(lhe_event, n_rw, normalise=True):
+  w = [value for wt_id, value in lhe_event.Weights()]
+  w = w[-n_rw:] #typically the desired reweights are at the end of the list
+
+  if normalise:
+    w = np.array(w)
+    w = w/w[0]
+    return list(w)
+  return w
+
+def getEvents(filename, start=0, stop=None):  
+  print("Reading %s"%filename)
+
+  for i, lhe_event in enumerate(openEvents(filename, start, stop), start=start):
+    yield makeEvent(i, lhe_event)
+
+def getReweightsFromFile(filename, n_rw, normalise=True, start=0, stop=None):
+  for lhe_event in openEvents(filename, start, stop):
+    yield getReweights(lhe_event, n_rw, normalise)
+
+def getEventsAndReweights(filename, n_rw, normalise=True, start=0, stop=None):
+  """
+  Yield (event, reweights) for each event, as from getEvents and getReweightsFromFile but
+  reading the file only once
+  """
+  print("Reading %s"%filename)
+
+  for i, lhe_event in enumerate(openEvents(filename, start, stop), start=start):
+    yield makeEvent(i, lhe_event), getReweights(lhe_event, n_rw, normalise)
+
+def getEventBatches(filename, n_rw, batch_size=1000, normalise=True, start=0, stop=None):
+  """
+  Batch version of getEventsAndReweights. Yields (batch, reweights) for up to batch_size
+  events at a time, where batch is an EventBatch (see event.py) and reweights an array
+  (nevents, n_rw) in which missing reweights are NaN. batch.getReweights(rw) computes the
+  weights of all events with a single call to StandaloneReweight.ComputeWeightsBatch.
+  """
   print("Reading %s"%filename)
-  reader = ROOT.LHEF.Reader(filename)
-
-  n_events = 0
-  while(reader.readEvent()):
-    n_events += 1
-    weight = reader.hepeup.XWGTUP
-    alphas = reader.hepeup.AQCDUP
-    scale2 = 0.0
-    parts = []
-
-    for i in range(reader.hepeup.NUP):        
-      p = reader.hepeup.PUP[i]
-      pdg = reader.hepeup.IDUP[i]
-      status = reader.hepeup.ISTUP[i]
-      helicity = reader.hepeup.SPINUP[i]
-
-      parts.append(Particle([p[3],p[0],p[1],p[2]], pdg, status, helicity))
-
-    yield Event(n_events-1, weight, parts, alphas, scale2)
-
-def getReweightsFromFile(filename, n_rw, normalise=True):
-  reader = ROOT.LHEF.Reader(filename)
-  
-  while(reader.readEvent()):
-    w = [i[0] for i in reader.hepeup.weights]
-    w = w[-n_rw:] #typically the desired reweights are at the end of the list
-
-    if normalise:
-      w = np.array(w)
-      w = w/w[0]
-      yield list(w)
-    else:
-      yield w
+
+  batch = []
+  for i, lhe_event in enumerate(openEvents(filename, start, stop), start=start):
+    batch.append((i, lhe_event))
+    if len(batch) == batch_size:
+      yield makeBatch(batch, n_rw, normalise)
+      batch = []
+  if batch:
+    yield makeBatch(batch, n_rw, normalise)
+
+def makeBatch(batch, n_rw, normalise=True):
+  lhe_events = [lhe_event for i, lhe_event in batch]
+  event_batch = EventBatch([i for i, lhe_event in batch],
+                           [lhe_event.xwgtup for lhe_event in lhe_events],
+                           np.concatenate([lhe_event.parts for lhe_event in lhe_events]),
+                           np.concatenate([lhe_event.pdgs for lhe_event in lhe_events]),
+                           np.concatenate([lhe_event.stats for lhe_event in lhe_events]),
+                           np.concatenate([lhe_event.hels for lhe_event in lhe_events]),
+                           np.cumsum([0] + [lhe_event.nup for lhe_event in lhe_events]),
+                           [lhe_event.aqcdup for lhe_event in lhe_events])
+
+  reweights = np.full((len(batch), n_rw), np.nan)
+  for j, lhe_event in enumerate(lhe_events):
+    w = getReweights(lhe_event, n_rw, normalise)
+    if len(w) > 0:
+      reweights[j, n_rw - len(w):] = w
+  return event_batch, reweights
 
 if __name__=="__main__":
   import sys
  
   filename = sys.argv[1]
-  gen = getEvents(filename)
 
   n_rw = 0
   try:
     n_rw = int(sys.argv[2])
   except:
     pass
-  
-  if n_rw>0:
-    reweights_gen = getReweightsFromFile(filename, n_rw, False)
+  start = 0
+  try:
+    start = int(sys.argv[3])
+  except:
+    pass
+  gen = getEventsAndReweights(filename, n_rw, False, start)
 
   end = False
   while not end:
     for i in range(5):
       try:
-        print(next(gen))
+        event, reweights = next(gen)
+        print(event)
         if n_rw>0:
-          print("Reweights: " + str(next(reweights_gen)))
+          print("Reweights: " + str(reweights))
       except:
         print("End of file reached")
         end = True
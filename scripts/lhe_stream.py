@@ -0,0 +1,554 @@
+"""
+Lightweight reader and writer for Les Houches event files, used by the standalone_reweight.py
+command line interface in place of ROOT.LHEF.
+
+Plain (.lhe) and gzipped (.lhe.gz) files are supported for both input and output. Events are
+streamed one at a time and kept as the original text: only the particle block is parsed, and
+on output the text is copied verbatim apart from the reweighting information. Any existing
+<rwgt> and <weights> blocks are replaced by a new <rwgt> block, and any existing <initrwgt>
+block in the init section is replaced by a new one. These blocks are written in exactly the
+format of the LHEF::Writer from LHEF.h, so downstream tools see the same weights as before.
+
+WeightSidecarWriter writes only the weights, to a compressed numpy .npz file, and JoinWeights
+adds them back to the events of the original LHE file.
+
+ThreadedReader and ThreadedWriter move the file access, decompression and parsing into
+background threads that communicate through bounded queues.
+
+LoadIndex builds an index of the offset of every event, saved next to the file as
+<file>.index.npz and rebuilt automatically when the file changes. With it, LHEReader gives
+random access to events (reader[i], reader[a:b]) and ShardRanges splits a file into equal
+parts without reading it first. For a gzipped file the offsets are positions in the
+uncompressed stream: seeking forwards decompresses up to the new position and seeking
+backwards restarts from the beginning of the file, so random access is much cheaper for
+plain files.
+"""
+import gzip
+import os
+import re
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy
+
+# Number of significant digits used by LHEF::Writer (std::numeric_limits<double>::digits10)
+DPREC = 15
+
+WGT_RE = re.compile(r'<wgt[^>]*?\bid\s*=\s*[\'"]([^\'"]*)[\'"][^>]*>([^<]*)</wgt>')
+
+INDEX_SUFFIX = '.index.npz'
+
+
+def OpenFile(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def FormatDouble(val):
+    """Equivalent of streaming a double to a std::ostream with setprecision(DPREC)"""
+    return '%.*g' % (DPREC, val)
+
+
+def FindBlock(lines, start_tag, end_tag):
+    """Return the [first, last) line range of the first start_tag ... end_tag block, or None"""
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith(start_tag):
+            for j in range(i, len(lines)):
+                if end_tag in lines[j]:
+                    return i, j + 1
+            raise RuntimeError('Unterminated %s block in LHE file' % start_tag)
+    return None
+
+
+def InitRwgtBlock(weights, group_type=''):
+    """
+    The <initrwgt> block for a list of (id, description) pairs, all in one weight group,
+    as printed by LHEF::HEPRUP
+    """
+    if len(weights) == 0:
+        return ''
+    out = '<initrwgt>\n<weightgroup type="%s">\n' % group_type
+    for name, contents in weights:
+        if contents:
+            out += '<weight id="%s">%s</weight>\n' % (name, contents)
+        else:
+            out += '<weight id="%s"/>\n' % name
+    return out + '</weightgroup>\n</initrwgt>\n'
+
+
+def RwgtBlock(names, values):
+    """The <rwgt> block of an event, as printed by LHEF::HEPEUP"""
+    if len(names) == 0:
+        return ''
+    out = '<rwgt>\n'
+    for name, val in zip(names, values):
+        out += '<wgt id="%s"> %s</wgt>\n' % (name, FormatDouble(val))
+    return out + '</rwgt>\n'
+
+
+class LHEEvent(object):
+    """
+    One event from an LHE file. The text is stored as a list of lines (including the <event>
+    and </event> tags) and the particle information as numpy arrays.
+    """
+
+    def __init__(self, lines, comments='', offset=None):
+        self.lines = lines
+        self.comments = comments
+        # Position in the input file directly after this event
+        self.offset = offset
+        info = lines[1].split()
+        self.nup = int(info[0])
+        self.xwgtup = float(info[2])
+        self.aqcdup = float(info[5])
+        table = numpy.array(' '.join(lines[2:2 + self.nup]).split(), dtype=numpy.float64).reshape(self.nup, 13)
+        self.pdgs = table[:, 0].astype(numpy.int64)
+        self.stats = table[:, 1].astype(numpy.int64)
+        # Put in EPxPyPz format
+        self.parts = table[:, [9, 6, 7, 8]]
+        self.hels = numpy.round(table[:, 12]).astype(numpy.int64)
+
+    def Info(self):
+        """The particle information in the format used by StandaloneReweight.ComputeWeights, as numpy arrays"""
+        return self.parts, self.pdgs, self.hels, self.stats, self.aqcdup
+
+    def Weights(self):
+        """The existing named weights of the event, as a list of (id, value)"""
+        block = FindBlock(self.lines, '<rwgt', '</rwgt>')
+        if block is None:
+            return []
+        return [(wt_id, float(value.split()[0])) for wt_id, value in WGT_RE.findall(''.join(self.lines[block[0]:block[1]]))]
+
+    def Text(self, names=None, values=None):
+        """
+        The event text, optionally with the <rwgt> and <weights> blocks replaced by a new
+        <rwgt> block. The new block goes where the old <rwgt> block was, otherwise directly
+        after the particle lines.
+        """
+        if names is None:
+            return self.comments + ''.join(self.lines)
+        lines = list(self.lines)
+        pos = 2 + self.nup
+        for start_tag, end_tag in [('<rwgt', '</rwgt>'), ('<weights', '</weights>')]:
+            block = FindBlock(lines, start_tag, end_tag)
+            if block is not None:
+                del lines[block[0]:block[1]]
+                if start_tag == '<rwgt':
+                    pos = block[0]
+                elif block[0] < pos:
+                    pos -= block[1] - block[0]
+        lines.insert(pos, RwgtBlock(names, values))
+        return self.comments + ''.join(lines)
+
+
+class LHEReader(object):
+    """
+    Reads the header and init block on construction, then yields LHEEvent objects when
+    iterated over. Text between events is attached to the following event as comments.
+    The offset of each event in the file (in the uncompressed stream for a gzipped file) is
+    tracked, so that reading can be restarted after any event with Seek.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = OpenFile(filename, 'rb')
+        self.offset = 0
+        self.index = None
+        self.header = ''
+        self.init = []
+        in_init = False
+        for line in self.file:
+            self.offset += len(line)
+            line = line.decode('utf-8')
+            if not in_init and '<init>' in line:
+                in_init = True
+            if in_init:
+                self.init.append(line)
+                if '</init>' in line:
+                    break
+            else:
+                self.header += line
+        if not self.header.lstrip().startswith('<LesHouchesEvents'):
+            raise RuntimeError('Tried to read a file which does not start with the LesHouchesEvents tag.')
+        if not self.init or '</init>' not in self.init[-1]:
+            raise RuntimeError('Found incomplete init tag in Les Houches file.')
+
+    def __iter__(self):
+        comments = ''
+        lines = None
+        for line in self.file:
+            self.offset += len(line)
+            line = line.decode('utf-8')
+            if lines is not None:
+                lines.append(line)
+                if '</event>' in line:
+                    yield LHEEvent(lines, comments, self.offset)
+                    comments = ''
+                    lines = None
+            elif line.lstrip().startswith('<event'):
+                lines = [line]
+            elif '</LesHouchesEvents>' not in line:
+                comments += line
+        if lines is not None:
+            raise RuntimeError('Found incomplete event in Les Houches file.')
+
+    def Seek(self, offset):
+        """Continue reading from offset, which should be the offset of an event"""
+        self.file.seek(offset)
+        self.offset = offset
+
+    def Index(self):
+        """The offsets of all events, see LoadIndex"""
+        if self.index is None:
+            self.index = LoadIndex(self.filename)
+        return self.index
+
+    def __len__(self):
+        return len(self.Index())
+
+    def __getitem__(self, key):
+        index = self.Index()
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(index))
+            if step == 1:
+                return list(self.Events(start, stop))
+            return [self[i] for i in range(start, stop, step)]
+        if key < 0:
+            key += len(index)
+        if key < 0 or key >= len(index):
+            raise IndexError('Event %i is out of range for %i events' % (key, len(index)))
+        return next(self.Events(key, key + 1))
+
+    def Events(self, start, stop):
+        """
+        Iterate over events start to stop - 1, e.g. one of the ranges from ShardRanges. Text
+        before the first event is not attached to it as comments.
+        """
+        if start >= stop:
+            return
+        self.Seek(self.Index()[start])
+        for i, event in enumerate(self, start=start + 1):
+            yield event
+            if i == stop:
+                return
+
+    def InitBlock(self, weights=None, group_type=''):
+        """
+        The init block text. If weights, a list of (id, description) pairs, is given then any
+        existing <initrwgt> block is replaced by a new one for these weights
+        """
+        if weights is None:
+            return ''.join(self.init)
+        lines = list(self.init)
+        block = FindBlock(lines, '<initrwgt', '</initrwgt>')
+        if block is not None:
+            del lines[block[0]:block[1]]
+        lines.insert(len(lines) - 1, InitRwgtBlock(weights, group_type))
+        return ''.join(lines)
+
+    def Close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+def IndexFilename(filename):
+    return filename + INDEX_SUFFIX
+
+
+def BuildIndex(filename, block_size=1 << 24):
+    """
+    The offsets of the <event> lines of all events in filename (in the uncompressed stream for
+    a gzipped file), as an int64 array. The file is scanned in large blocks without parsing
+    the events.
+    """
+    reader = LHEReader(filename)
+    offsets = []
+    # buf always starts at the beginning of a line, at position pos in the file
+    pos = reader.offset
+    buf = b''
+    while True:
+        block = reader.file.read(block_size)
+        buf += block
+        end = buf.rfind(b'\n') + 1 if block else len(buf)
+        i = buf.find(b'<event', 0, end)
+        while i >= 0:
+            line_start = buf.rfind(b'\n', 0, i) + 1
+            if not buf[line_start:i].strip():
+                offsets.append(pos + line_start)
+            i = buf.find(b'<event', i + 6, end)
+        pos += end
+        buf = buf[end:]
+        if not block:
+            break
+    reader.Close()
+    return numpy.array(offsets, dtype=numpy.int64)
+
+
+def SaveIndex(filename, offsets):
+    """Save the index next to filename, together with the size and mtime of the file"""
+    stat = os.stat(filename)
+    tmp_name = IndexFilename(filename) + '.tmp'
+    with open(tmp_name, 'wb') as outfile:
+        numpy.savez(outfile, offsets=offsets, size=stat.st_size, mtime=stat.st_mtime_ns)
+    os.replace(tmp_name, IndexFilename(filename))
+
+
+def LoadIndex(filename, build=True):
+    """
+    The event offsets of filename, from the index saved next to it. If that is missing or
+    does not match the current size and mtime of the file, the index is rebuilt and saved
+    (or None is returned if build is False).
+    """
+    stat = os.stat(filename)
+    try:
+        with numpy.load(IndexFilename(filename)) as data:
+            if int(data['size']) == stat.st_size and int(data['mtime']) == stat.st_mtime_ns:
+                return data['offsets']
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    if not build:
+        return None
+    offsets = BuildIndex(filename)
+    try:
+        SaveIndex(filename, offsets)
+    except (IOError, OSError) as e:
+        print('>> Could not save the event index of %s: %s' % (filename, e))
+    return offsets
+
+
+def ShardRanges(n_events, n_shards):
+    """Split n_events into n_shards contiguous (start, stop) ranges that differ in size by at most one"""
+    return [(n_events * i // n_shards, n_events * (i + 1) // n_shards) for i in range(n_shards)]
+
+
+class LHEWriter(object):
+    """
+    Writes text blocks to a (possibly gzipped) LHE file and closes it with </LesHouchesEvents>.
+    If resume_offset is given, an existing uncompressed file is truncated at this offset and
+    the new text is appended from there.
+    """
+
+    def __init__(self, filename, resume_offset=None):
+        self.filename = filename
+        if resume_offset is None:
+            self.file = OpenFile(filename, 'wb')
+            self.offset = 0
+        else:
+            if filename.endswith('.gz'):
+                raise RuntimeError('Cannot resume writing a gzipped file')
+            self.file = open(filename, 'r+b')
+            self.file.truncate(resume_offset)
+            self.file.seek(resume_offset)
+            self.offset = resume_offset
+
+    def Write(self, text):
+        data = text.encode('utf-8')
+        self.file.write(data)
+        self.offset += len(data)
+
+    def Sync(self):
+        """Make sure everything written so far is on disk"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def Close(self):
+        self.Write('</LesHouchesEvents>\n')
+        self.file.close()
+
+
+class WeightSidecarWriter(object):
+    """
+    Writes the weights of each event to a compressed .npz file instead of a new LHE file.
+    The file contains:
+
+        weights       (nevents, N) weights relative to the original event weight, as
+                      returned by StandaloneReweight.ComputeWeights
+        transformed   (nevents, N) the same after StandaloneReweight.TransformWeights
+        xwgtup        (nevents) the original event weight
+        offset        (nevents) offset in the input LHE file directly after each event
+        names         (N) weight names, rw0000, rw0001, ...
+        active        indices of the selected reweight points, the other columns are NaN
+        input         the input file name
+
+    Rows are appended to temporary files next to the output as they arrive, so the memory
+    use does not grow with the number of events, and the .npz is only created by Close.
+    Write takes a tuple of arrays (weights, transformed, xwgtup, offset). The number of
+    events written is kept in offset, and resume_offset continues after this many events.
+    """
+    COLUMNS = [('weights', 2), ('transformed', 2), ('xwgtup', 1), ('offset', 1)]
+
+    def __init__(self, filename, N, active, input_name, resume_offset=None):
+        self.filename = filename
+        self.N = N
+        self.extra = {'names': numpy.array(['rw%.4i' % iw for iw in range(N)]), 'active': numpy.array(active, dtype=numpy.int64), 'input': numpy.array(input_name)}
+        self.dtypes = {'weights': numpy.float64, 'transformed': numpy.float64, 'xwgtup': numpy.float64, 'offset': numpy.int64}
+        self.files = []
+        for name, ndim in self.COLUMNS:
+            tmp_name = '%s.%s.tmp' % (filename, name)
+            if resume_offset is None:
+                self.files.append(open(tmp_name, 'wb'))
+            else:
+                tmp_file = open(tmp_name, 'r+b')
+                tmp_file.truncate(resume_offset * (N if ndim == 2 else 1) * 8)
+                tmp_file.seek(0, os.SEEK_END)
+                self.files.append(tmp_file)
+        self.offset = 0 if resume_offset is None else resume_offset
+
+    def Write(self, rows):
+        for (name, ndim), tmp_file, arr in zip(self.COLUMNS, self.files, rows):
+            tmp_file.write(numpy.ascontiguousarray(arr, dtype=self.dtypes[name]).tobytes())
+        self.offset += len(rows[0])
+
+    def Sync(self):
+        for tmp_file in self.files:
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+
+    def Close(self):
+        arrays = dict(self.extra)
+        for (name, ndim), tmp_file in zip(self.COLUMNS, self.files):
+            tmp_file.close()
+            shape = (self.offset, self.N) if ndim == 2 else (self.offset,)
+            if self.offset > 0:
+                arrays[name] = numpy.memmap(tmp_file.name, dtype=self.dtypes[name], mode='r', shape=shape)
+            else:
+                arrays[name] = numpy.zeros(shape, dtype=self.dtypes[name])
+        # Write under a temporary name so that an incomplete file is never left behind
+        tmp_name = self.filename + '.tmp.npz'
+        numpy.savez_compressed(tmp_name, **arrays)
+        os.replace(tmp_name, self.filename)
+        for tmp_file in self.files:
+            os.remove(tmp_file.name)
+
+
+def JoinWeights(input_name, sidecar_name, output_name):
+    """
+    Write a new LHE file with the weights from a WeightSidecarWriter file added to the events
+    of the original LHE file. The output is identical to that of standalone_reweight.py run
+    directly with LHE output. Returns the number of events.
+    """
+    sidecar = numpy.load(sidecar_name)
+    active = sidecar['active'].tolist()
+    names = [str(sidecar['names'][iw]) for iw in active]
+    weights = sidecar['weights']
+    offsets = sidecar['offset']
+    reader = LHEReader(input_name)
+    writer = LHEWriter(output_name)
+    writer.Write(reader.header)
+    writer.Write(reader.InitBlock([(name, 'from param_card_%i.dat' % iw) for name, iw in zip(names, active)]))
+    neve = 0
+    for event in reader:
+        if neve >= len(offsets) or event.offset != offsets[neve]:
+            raise RuntimeError('Event %i of %s does not match the weight file %s' % (neve, input_name, sidecar_name))
+        writer.Write(event.Text(names, (weights[neve, active] * event.xwgtup).tolist()))
+        neve += 1
+    if neve != len(offsets):
+        raise RuntimeError('The weight file %s has %i events but %s has %i' % (sidecar_name, len(offsets), input_name, neve))
+    writer.Close()
+    reader.Close()
+    return neve
+
+
+class ThreadedReader(object):
+    """
+    Reads and parses events from an LHEReader in a background thread, and yields them in
+    lists of up to batch_size events. At most maxsize batches are buffered.
+    """
+
+    def __init__(self, reader, batch_size, maxsize=4):
+        self.reader = reader
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Put(self, item):
+        # Give up if the consumer has gone away, otherwise this could block forever
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Run(self):
+        try:
+            batch = []
+            for event in self.reader:
+                batch.append(event)
+                if len(batch) == self.batch_size:
+                    if not self.Put(batch):
+                        return
+                    batch = []
+            if batch:
+                self.Put(batch)
+            self.Put(None)
+        except Exception as e:
+            self.Put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.stop.set()
+            self.thread.join()
+
+
+class ThreadedWriter(object):
+    """
+    Writes to an LHEWriter (or a WeightSidecarWriter) from a background thread. Write blocks
+    if maxsize items are already waiting. Errors in the writer thread are raised by the next
+    Write or by Close. If a callback is given to Write, it is called with the writer from the
+    writer thread once the data has been written.
+    """
+
+    def __init__(self, writer, maxsize=4):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    data, callback = item
+                    self.writer.Write(data)
+                    if callback is not None:
+                        callback(self.writer)
+                except Exception as e:
+                    self.error = e
+
+    def Write(self, data, callback=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((data, callback))
+
+    def Close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.writer.Close()
@@ -1,9 +1,36 @@
 import re
+import gzip
+import warnings
 from dataclasses import dataclass, field
 from xml.etree import ElementTree
 
+import numpy as np
 from vector import MomentumObject4D 
 
+from . import fixed_width
+
+# One row per particle in the arrays returned by LHEReader.iter_chunks
+PARTICLE_DTYPE = np.dtype([
+    ('pdgid', np.int64),
+    ('status', np.int64),
+    ('parent', np.int64),
+    ('px', np.float64),
+    ('py', np.float64),
+    ('pz', np.float64),
+    ('energy', np.float64),
+    ('mass', np.float64),
+    ('vtau', np.float64),
+    ('spin', np.int64),
+])
+
+# The columns of a particle line that are stored in PARTICLE_DTYPE
+PARTICLE_COLUMNS = (0, 1, 2, 6, 7, 8, 9, 10, 11, 12)
+
+# The event header line and the particle lines up to the next tag, in the raw bytes of a file
+EVENT_REGEX = re.compile(rb'<event\b[^>]*>[^\n]*\n([^\n]*)\n([^<]*)')
+WGT_REGEX = re.compile(r"""<wgt[^>]*?\bid\s*=\s*['"]([^'"]*)['"][^>]*>([^<]*)</wgt>""")
+INIT_WEIGHT_REGEX = re.compile(r"""<weight\b[^>]*?\bid\s*=\s*['"]([^'"]*)['"]""")
+
 @dataclass
 class Particle:
     pdgid: int
@@ -31,6 +58,26 @@ class Event:
         self.particles.append(particle)
 
 
+@dataclass
+class EventChunk:
+    """
+    A block of events in columnar form. The particles of event i are
+    particles[offsets[i]:offsets[i+1]], and its weights are weights[i], with one
+    column per entry of weight_ids.
+    """
+    particles: np.ndarray
+    offsets: np.ndarray
+    scale: np.ndarray
+    weights: np.ndarray
+    weight_ids: list
+
+    def __len__(self):
+        return len(self.scale)
+
+    def event_particles(self, i):
+        return self.particles[self.offsets[i]:self.offsets[i+1]]
+
+
 class LHEReader():
     def __init__(self, file_path, weight_mode='list', weight_regex = '.*'):
         '''
@@ -38,7 +85,8 @@ class LHEReader():
 
         :param file_path: Path to input LHE file
         :type file_path: string
-        :param weight_mode: Format to return weights as. Can be dict or list. If dict, weight IDs are used as keys.
+        :param weight_mode: Format to return weights as. Can be dict, list or array. If dict, weight IDs are used as keys.
+            If array, the weights are a float64 array with one entry per weight_ids, NaN for weights missing from the event.
         :type weight_mode: string
         :param weight_regex: Regular expression to select weights to be read. Defaults to reading all.
         :type weight_regex: string
@@ -48,10 +96,57 @@ class LHEReader():
         self.current = None
         self.current_weights = None
 
-        assert(weight_mode in ['list','dict'])
+        assert(weight_mode in ['list','dict','array'])
         self.weight_mode = weight_mode
         self.weight_regex = re.compile(weight_regex)
 
+        # The selected weight ids, in column order. Taken from the <initrwgt> block of the
+        # header if there is one, otherwise from the first event.
+        self.init_weight_ids = self.read_init_weight_ids()
+        self.weight_ids = self.init_weight_ids
+        # Column of each weight id seen so far, or None if it is not selected
+        self._weight_columns = {}
+
+    def _open(self, mode='rt'):
+        return gzip.open(self.file_path, mode) if self.file_path.endswith('.gz') else open(self.file_path, mode)
+
+    def read_init_weight_ids(self):
+        '''
+        Read the ids of the weights declared in the <initrwgt> block of the header that are
+        selected by weight_regex.
+
+        :return: List of weight ids, or None if the file has no <initrwgt> block
+        '''
+        lines = []
+        with self._open() as infile:
+            for line in infile:
+                if '<event' in line:
+                    break
+                lines.append(line)
+        header = ''.join(lines)
+        start = header.find('<initrwgt')
+        if start < 0:
+            return None
+        block = header[start:header.find('</initrwgt>', start)]
+        return [weight_id for weight_id in INIT_WEIGHT_REGEX.findall(block) if self.weight_regex.match(weight_id)]
+
+    def _weight_column(self, weight_id):
+        '''
+        Column of a weight id in weight_ids, -1 if it is selected but has no column (yet),
+        or None if it is not selected. The regex is only matched once per id.
+        '''
+        if weight_id not in self._weight_columns:
+            if not self.weight_regex.match(weight_id):
+                self._weight_columns[weight_id] = None
+            elif self.weight_ids is None:
+                # Only known at the end of the first event
+                return -1
+            elif weight_id in self.weight_ids:
+                self._weight_columns[weight_id] = self.weight_ids.index(weight_id)
+            else:
+                self._weight_columns[weight_id] = -1
+        return self._weight_columns[weight_id]
+
     def unpack_from_iterator(self):
         # Read the lines for this event
         lines = self.current[1].text.strip().split("\n")
@@ -85,6 +180,284 @@ class LHEReader():
     def __iter__(self):
         return self
 
+    def iter_chunks(self, n, block_size=1 << 24):
+        '''
+        Read the file in blocks of up to n events, parsed straight into numpy arrays instead
+        of one Particle object per particle. This is much faster than iterating over the
+        reader, and also accepts gzipped files.
+
+        Each block of events is parsed as a whole: one regex pass finds the event headers
+        and particle lines, and the particle lines and weights are converted column by
+        column (see fixed_width) when, as in MadGraph output, all events are written with
+        the same fixed-width layout. Otherwise the particles are read with np.loadtxt and
+        the weights of each event with a regex.
+
+        Weights are selected with weight_regex in the same way as for the iteration. The
+        columns of the weight matrix are given by weight_ids: in list mode the selected
+        weights of each event are taken in order, and in dict and array mode they are
+        matched by id. Weights missing from an event are NaN, and extra weights raise a
+        ValueError.
+
+        :param n: Maximum number of events per chunk
+        :type n: int
+        :param block_size: Number of bytes read from the file at a time
+        :type block_size: int
+        :return: Iterator over EventChunk objects
+        '''
+        self.weight_ids = self.init_weight_ids
+        self._layouts = {}
+        with self._open('rb') as infile:
+            # A bytearray can be extended without copying what was read before
+            data = bytearray()
+            # The offsets in data just after the </event> tag of each complete event
+            ends = []
+            while True:
+                block = infile.read(block_size)
+                data += block
+                while True:
+                    pos = data.find(b'</event>', ends[-1] if ends else 0)
+                    if pos < 0:
+                        break
+                    ends.append(pos + len(b'</event>'))
+                    if len(ends) == n:
+                        # Only the start of the next chunk is copied, not the events parsed now
+                        rest = data[ends[-1]:]
+                        del data[ends[-1]:]
+                        yield self._parse_chunk(data, ends)
+                        data = rest
+                        ends = []
+                if not block:
+                    break
+            if ends:
+                yield self._parse_chunk(data, ends)
+
+    def _parse_chunk(self, data, ends):
+        '''
+        Parse a bytearray of complete events into an EventChunk, see iter_chunks.
+
+        :param data: The bytes of the events
+        :param ends: The offset just after the </event> tag of each event
+        '''
+        matches = []
+        start = 0
+        for end in ends:
+            # Each event is searched for on its own, so that the weights are not scanned
+            match = EVENT_REGEX.search(data, start, end)
+            if match is None:
+                return self._parse_events(data.decode('utf-8'))
+            matches.append(match)
+            start = end
+        headers = np.loadtxt(b'\n'.join([match.group(1) for match in matches]).decode('utf-8').split('\n'), usecols=(0, 3), ndmin=2)
+        nparts = headers[:, 0].astype(np.int64)
+        part_data = b''.join([match.group(2) for match in matches])
+        table = fixed_width.parse_table(part_data, 13, PARTICLE_COLUMNS)
+        if table is None:
+            table = np.loadtxt(part_data.decode('utf-8').split('\n'), usecols=PARTICLE_COLUMNS, ndmin=2)
+        if len(table) != nparts.sum():
+            return self._parse_events(data.decode('utf-8'))
+        # Everything after the particles of each event, i.e. the weights and any comments
+        starts = [match.end() for match in matches]
+        weights = self._block_weights(data, starts, ends)
+        if weights is None:
+            weights = self._chunk_weights([data[start:end].decode('utf-8') for start, end in zip(starts, ends)])
+        return self._build_chunk(table, nparts, headers[:, 1], weights)
+
+    def _parse_events(self, text):
+        '''
+        Parse a block of complete events one event at a time, for files that EVENT_REGEX
+        does not match.
+        '''
+        chunk = self._new_chunk()
+        for event_text in text.split('</event>'):
+            self._parse_event(event_text, chunk)
+        return self._make_chunk(chunk)
+
+    @staticmethod
+    def _new_chunk():
+        return {'part_lines': [], 'nparts': [], 'scales': [], 'extras': []}
+
+    def _weight_layout(self, ids):
+        '''
+        Resolve the ids of all <wgt> tags of an event, in order, into the positions of the
+        selected weights and their columns in the weight matrix. Cached per distinct layout.
+        '''
+        key = tuple(ids)
+        if key in self._layouts:
+            return self._layouts[key]
+        positions = [i for i, weight_id in enumerate(ids) if self.weight_regex.match(weight_id)]
+        if self.weight_ids is None:
+            self.weight_ids = [ids[i] for i in positions]
+        if self.weight_mode == 'list':
+            if len(positions) > len(self.weight_ids):
+                raise ValueError('Event has %i selected weights, but there are only %i weight_ids' % (len(positions), len(self.weight_ids)))
+            cols = np.arange(len(positions))
+        else:
+            weight_cols = {weight_id: i for i, weight_id in enumerate(self.weight_ids)}
+            missing = [ids[i] for i in positions if ids[i] not in weight_cols]
+            if missing:
+                raise ValueError('Weight id %s is not in weight_ids' % missing[0])
+            cols = np.array([weight_cols[ids[i]] for i in positions], dtype=np.int64)
+        self._layouts[key] = (positions, cols)
+        return positions, cols
+
+    def _parse_event(self, text, chunk):
+        start = text.find('<event')
+        if start < 0:
+            return
+        # Skip the rest of the <event ...> line, then the event header line
+        start = text.index('\n', start) + 1
+        pos = text.index('\n', start)
+        header = text[start:pos].split()
+        num_part = int(header[0])
+        start = pos + 1
+        for i in range(num_part):
+            pos = text.index('\n', pos + 1)
+        chunk['part_lines'].append(text[start:pos])
+        chunk['nparts'].append(num_part)
+        chunk['scales'].append(float(header[3]))
+        # Everything after the particles, i.e. the weights and any comments
+        chunk['extras'].append(text[pos:])
+
+    def _fast_weights(self, extras):
+        '''
+        Weights of a whole chunk in one go, for the usual case where every event has the
+        same <rwgt> block as the first one apart from the values. Returns None if that is
+        not the case.
+        '''
+        found = WGT_REGEX.findall(extras[0])
+        start = extras[0].find('<rwgt>')
+        if not found or start < 0:
+            return None
+        ref = extras[0][start + 6:extras[0].find('</rwgt>', start)].strip().split('>')
+        # i.e. ['<wgt id=...', ' value </wgt', ..., '']
+        if len(ref) != 2 * len(found) + 1 or not all(piece.rstrip().endswith('</wgt') for piece in ref[1::2]):
+            return None
+        blocks = []
+        for text in extras:
+            start = text.find('<rwgt>')
+            blocks.append(text[start + 6:text.find('</rwgt>', start)].strip() if start >= 0 else '')
+        pieces = ''.join(blocks).split('>')
+        nevents = len(extras)
+        # The tags must match the first event exactly, and there may be no <wgt> outside <rwgt>
+        if pieces[0::2] != ref[0:-1:2] * nevents + [''] or sum(text.count('<wgt') for text in extras) != len(found) * nevents:
+            return None
+        # All values are converted in one pass, without splitting them into strings first
+        try:
+            with warnings.catch_warnings():
+                # Older numpy versions only warn if the text is not all numbers
+                warnings.simplefilter('error', DeprecationWarning)
+                values = np.fromstring(' '.join(pieces[1::2]).replace('</wgt', ' '), dtype=np.float64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            return None
+        if len(values) != len(found) * nevents:
+            return None
+        values = values.reshape(nevents, len(found))
+        positions, cols = self._weight_layout([weight_id for weight_id, value in found])
+        weights = np.full((nevents, len(self.weight_ids)), np.nan)
+        weights[:, cols] = values[:, positions]
+        return weights
+
+    def _chunk_weights(self, extras):
+        if extras:
+            weights = self._fast_weights(extras)
+            if weights is not None:
+                return weights
+        # General case, event by event
+        values = []
+        all_cols = []
+        for text in extras:
+            found = WGT_REGEX.findall(text)
+            positions, cols = self._weight_layout([weight_id for weight_id, value in found])
+            values.extend([found[i][1] for i in positions])
+            all_cols.append(cols)
+        weights = np.full((len(extras), len(self.weight_ids) if self.weight_ids is not None else 0), np.nan)
+        if values:
+            counts = [len(cols) for cols in all_cols]
+            weights[np.repeat(np.arange(len(extras)), counts), np.concatenate(all_cols)] = np.array(values, dtype=np.float64)
+        return weights
+
+    def _block_weights(self, data, starts, ends):
+        '''
+        Weights of a whole chunk for the case where the text after the particles of every
+        event is exactly the same as in the first event apart from the values of the <wgt>
+        tags, and all values are written with the same fixed width. The events are then the
+        rows of a byte matrix, and the values are at the same columns in every row. Returns
+        None otherwise.
+
+        :param data: The bytes of the chunk
+        :param starts: The offset of the end of the particles of each event
+        :param ends: The offset of the end of each event
+        '''
+        starts = np.array(starts)
+        length = ends[0] - starts[0]
+        ref_text = data[starts[0]:ends[0]].decode('utf-8')
+        # The offsets below are only byte offsets for ASCII text
+        if (np.array(ends) - starts != length).any() or len(ref_text) != length:
+            return None
+        found = list(WGT_REGEX.finditer(ref_text))
+        if not found:
+            return None
+        value_starts = np.array([match.start(2) for match in found])
+        widths = np.array([match.end(2) - match.start(2) for match in found])
+        width = widths[0]
+        if (widths != width).any() or width == 0:
+            return None
+
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        rows = np.empty((len(starts), length), dtype=np.uint8)
+        for i, start in enumerate(starts.tolist()):
+            rows[i] = buffer[start:start + length]
+        # Everything apart from the values has to be the same as in the first event
+        is_value = np.zeros(length, dtype=bool)
+        for start in value_starts:
+            is_value[start:start + width] = True
+        differs = np.zeros(length, dtype=bool)
+        for i in range(0, len(rows), 4096):
+            differs |= (rows[i:i + 4096] != rows[0]).any(axis=0)
+        if differs[~is_value].any():
+            return None
+
+        steps = np.diff(value_starts)
+        if len(steps) == 0 or (steps == steps[0]).all():
+            # The usual case of one <wgt> per line, the values are a strided view of the rows
+            step = steps[0] if len(steps) else width
+            fields = np.lib.stride_tricks.as_strided(rows[:, value_starts[0]:], shape=(len(rows), len(found), width),
+                                                     strides=(rows.strides[0], step, 1), writeable=False)
+        else:
+            fields = rows[:, value_starts[:, None] + np.arange(width)]
+        values = fixed_width.parse_floats(fixed_width.to_columns(fields))
+        if values is None:
+            return None
+        positions, cols = self._weight_layout([match.group(1) for match in found])
+        weights = np.full((len(rows), len(self.weight_ids)), np.nan)
+        weights[:, cols] = values[:, positions]
+        return weights
+
+    def _make_chunk(self, chunk):
+        table = np.loadtxt('\n'.join(chunk['part_lines']).split('\n'), usecols=PARTICLE_COLUMNS, dtype=np.float64, ndmin=2)
+        weights = self._chunk_weights(chunk['extras'])
+        return self._build_chunk(table, np.array(chunk['nparts'], dtype=np.int64), np.array(chunk['scales'], dtype=np.float64), weights)
+
+    def _build_chunk(self, table, nparts, scales, weights):
+        '''
+        Build an EventChunk from the PARTICLE_COLUMNS of the particle lines, the number of
+        particles and scale of each event and the weights matrix
+        '''
+        particles = np.empty(len(table), dtype=PARTICLE_DTYPE)
+        if len(table):
+            particles['pdgid'] = table[:, 0]
+            particles['status'] = table[:, 1]
+            particles['parent'] = table[:, 2] - 1
+            for i, name in enumerate(['px', 'py', 'pz', 'energy', 'mass', 'vtau', 'spin'], start=3):
+                particles[name] = table[:, i]
+        offsets = np.zeros(len(nparts) + 1, dtype=np.int64)
+        np.cumsum(nparts, out=offsets[1:])
+        return EventChunk(particles=particles,
+                          offsets=offsets,
+                          scale=np.asarray(scales, dtype=np.float64),
+                          weights=weights,
+                          weight_ids=list(self.weight_ids or []))
+
     def __next__(self):
         # Clear XML iterator
         if(self.current):
@@ -98,10 +471,15 @@ class LHEReader():
         # Loop over tags in this event
         element = next(self.iterator)
 
-        if self.weight_mode == 'list':
+        # In the first event of a file without <initrwgt>, the ids of the selected weights
+        # are recorded to define weight_ids
+        first_ids = [] if self.weight_ids is None else None
+        if self.weight_mode == 'list' or first_ids is not None:
             self.current_weights = []
         elif self.weight_mode == 'dict':
             self.current_weights = {}
+        else:
+            self.current_weights = np.full(len(self.weight_ids), np.nan)
 
         while not (element[0]=='end' and element[1].tag == "event"):
             if element[0]=='end' and element[1].tag == 'wgt':
@@ -110,15 +488,31 @@ class LHEReader():
                 # 1. filter which events to read
                 # 2. key for output dict
                 weight_id = element[1].attrib.get('id','')
+                col = self._weight_column(weight_id)
 
-                if self.weight_regex.match(weight_id):
+                # Weights that are not selected are not converted
+                if col is not None:
                     value = float(element[1].text)
-                    if self.weight_mode == 'list':
+                    if first_ids is not None:
+                        first_ids.append(weight_id)
+                        self.current_weights.append(value)
+                    elif self.weight_mode == 'list':
                         self.current_weights.append(value)
                     elif self.weight_mode == 'dict':
                         self.current_weights[weight_id] = value
+                    elif col < 0:
+                        raise ValueError('Weight id %s is not in weight_ids' % weight_id)
+                    else:
+                        self.current_weights[col] = value
             element = next(self.iterator)
 
+        if first_ids is not None:
+            self.weight_ids = first_ids
+            if self.weight_mode == 'dict':
+                self.current_weights = dict(zip(first_ids, self.current_weights))
+            elif self.weight_mode == 'array':
+                self.current_weights = np.array(self.current_weights, dtype=np.float64)
+
         # Find end up this event in XML
         # use it to construct particles, etc
         while not (element[0]=='end' and element[1].tag == "event"):
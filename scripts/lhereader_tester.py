@@ -0,0 +1,86 @@
+"""
+The point of this script is to validate LHEReader.iter_chunks against iterating over
+the reader one event at a time, and to compare their speed. No matrix element library
+is needed.
+
+The file is read with both methods in each weight mode (list, dict and array). The
+particles, scales and weights of every event are compared, and the script prints the
+number of events that disagree and the time taken by each method. The file must not be
+gzipped, as the iterator can only read plain LHE files.
+
+To run do:
+  python scripts/lhereader_tester.py <LHEFILE> <WEIGHTREGEX> <CHUNKSIZE> <VERB>
+<WEIGHTREGEX> = Regular expression selecting the weights, default is all
+<CHUNKSIZE> = Maximum number of events per chunk, default is 10000
+<VERB> = 0 -> Minimal output
+<VERB> = 1 -> Prints out events that fail
+"""
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+from lhereader import LHEReader, PARTICLE_DTYPE
+
+
+def iteratorWeights(event, weight_ids, mode):
+  """The weights of an event from the iterator, as a row of the EventChunk weight matrix"""
+  row = np.full(len(weight_ids), np.nan)
+  if mode == 'list':
+    row[:len(event.weights)] = event.weights
+  elif mode == 'dict':
+    for weight_id, value in event.weights.items():
+      row[weight_ids.index(weight_id)] = value
+  else:
+    row[:] = event.weights
+  return row
+
+def sameEvent(event, chunk, i, mode):
+  particles = chunk.event_particles(i)
+  if len(particles) != len(event.particles) or event.scale != chunk.scale[i]:
+    return False
+  for particle, row in zip(event.particles, particles):
+    if any(getattr(particle, name) != row[name] for name in PARTICLE_DTYPE.names):
+      return False
+  return np.array_equal(iteratorWeights(event, chunk.weight_ids, mode), chunk.weights[i], equal_nan=True)
+
+if __name__=="__main__":
+  filename = sys.argv[1]
+  try:
+    weight_regex = sys.argv[2]
+  except:
+    weight_regex = '.*'
+  try:
+    chunk_size = int(sys.argv[3])
+  except:
+    chunk_size = 10000
+  try:
+    VERB = int(sys.argv[4])
+  except:
+    VERB = 0
+
+  for mode in ['list', 'dict', 'array']:
+    t0 = time.time()
+    events = list(LHEReader(filename, weight_mode=mode, weight_regex=weight_regex))
+    t1 = time.time()
+    chunks = list(LHEReader(filename, weight_mode=mode, weight_regex=weight_regex).iter_chunks(chunk_size))
+    t2 = time.time()
+
+    n_chunk_events = sum(len(chunk) for chunk in chunks)
+    no_failed = abs(len(events) - n_chunk_events)
+    ievent = 0
+    for chunk in chunks:
+      for i in range(len(chunk)):
+        if ievent >= len(events):
+          break
+        if not sameEvent(events[ievent], chunk, i, mode):
+          no_failed += 1
+          if VERB >= 1:
+            print("Event %i" % ievent)
+            print("Iterator: %s" % events[ievent])
+            print("Chunk particles:\n%s" % chunk.event_particles(i))
+            print("Chunk weights: %s\n" % chunk.weights[i])
+        ievent += 1
+
+    print("%s: %i events, %i weights, %i failed" % (mode, len(events), len(chunks[0].weight_ids) if chunks else 0, no_failed))
+    print("%s: iterator %.3fs, iter_chunks %.3fs, speed up %.1fx" % (mode, t1 - t0, t2 - t1, (t1 - t0) / max(t2 - t1, 1e-9)))
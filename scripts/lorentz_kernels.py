@@ -0,0 +1,161 @@
+"""
+Vectorised versions of the Lorentz transformations used by standalone_reweight.py.
+
+All functions act on arrays of four-vectors in [E, px, py, pz] format, where the last
+axis has length 4. The momenta of a batch of events are given as an array of shape
+(nevents, nparticles, 4) and the boost vectors as an array of shape (nevents, 4).
+The results are equivalent to the one-vector-at-a-time methods zboost, rotZ, rotY and
+allboost of StandaloneReweight, including the snapping of small components to zero.
+"""
+import numpy
+
+SNAP = 1e-6
+
+
+def Snap(p, components=(1, 2, 3)):
+    """Set components smaller than SNAP * E to zero, in place"""
+    for i in components:
+        p[..., i][numpy.abs(p[..., i]) < SNAP * p[..., 0]] = 0.
+    return p
+
+
+def ZBoost(parts, pboost):
+    """
+    Boost along z such that pboost is at rest (only the z component of pboost is used).
+    parts has shape (..., nparticles, 4) and pboost (..., 4).
+    """
+    E = pboost[..., 0, None]
+    pz = pboost[..., 3, None]
+
+    gamma = E / numpy.sqrt(E**2 - pz**2)
+    gammabeta = pz / numpy.sqrt(E**2 - pz**2)
+
+    out = numpy.array(parts, dtype=numpy.float64)
+    out[..., 0] = gamma * parts[..., 0] - gammabeta * parts[..., 3]
+    out[..., 3] = gamma * parts[..., 3] - gammabeta * parts[..., 0]
+    return Snap(out, (3,))
+
+
+def RotZ(parts, angle):
+    """Rotate by angle (one per event) around the z axis, in place"""
+    c = numpy.cos(angle)[..., None]
+    s = numpy.sin(angle)[..., None]
+    p1 = parts[..., 1].copy()
+    p2 = parts[..., 2].copy()
+    parts[..., 1] = p1 * c - p2 * s
+    parts[..., 2] = p1 * s + p2 * c
+    return parts
+
+
+def RotY(parts, angle):
+    """Rotate by angle (one per event) around the y axis, in place"""
+    c = numpy.cos(angle)[..., None]
+    s = numpy.sin(angle)[..., None]
+    p1 = parts[..., 1].copy()
+    p3 = parts[..., 3].copy()
+    parts[..., 1] = p1 * c + p3 * s
+    parts[..., 3] = -p1 * s + p3 * c
+    return parts
+
+
+def AllBoost(parts, pboost):
+    """
+    Boost the particles into the rest frame of pboost. The same strategy as
+    StandaloneReweight.allboost is used: rotate pboost such that it lies along the z axis,
+    boost along z, then undo the rotations.
+    """
+    parts = numpy.array(parts, dtype=numpy.float64)
+    pboost = numpy.array(pboost, dtype=numpy.float64)
+
+    # rotate around z axis such that there is no y component
+    z_rot_angle = numpy.where(pboost[..., 1] != 0,
+                              numpy.arctan2(pboost[..., 2], pboost[..., 1]),
+                              numpy.where(pboost[..., 2] > 0, numpy.pi / 2, -numpy.pi / 2))
+    parts = RotZ(parts, -z_rot_angle)
+    pboost = RotZ(pboost[..., None, :], -z_rot_angle)[..., 0, :]
+
+    # rotate around y axis so pboost lies along z axis
+    r = numpy.sqrt(pboost[..., 1]**2 + pboost[..., 2]**2 + pboost[..., 3]**2)
+    y_rot_angle = numpy.arccos(pboost[..., 3] / r)
+    parts = RotY(parts, -y_rot_angle)
+    pboost = RotY(pboost[..., None, :], -y_rot_angle)[..., 0, :]
+
+    # perform Lorentz boost, then undo rotations
+    parts = ZBoost(parts, pboost)
+    parts = RotY(parts, y_rot_angle)
+    parts = RotZ(parts, z_rot_angle)
+    return Snap(parts)
+
+
+def BoostToCOM(parts, nInits):
+    """
+    Boost all particles of a batch of events (nevents, nparticles, 4) into the
+    centre-of-mass frame of the first nInits particles. Events where the initial state
+    has no transverse momentum are only boosted along z.
+    """
+    parts = numpy.asarray(parts, dtype=numpy.float64)
+    if nInits == 1:
+        pboost = parts[:, 0]
+    elif nInits == 2:
+        pboost = parts[:, 0] + parts[:, 1]
+    else:
+        raise Exception("More than two initial particles.")
+
+    has_pt = (pboost[:, 1] != 0) | (pboost[:, 2] != 0)
+    out = numpy.empty_like(parts)
+    if numpy.any(has_pt):
+        out[has_pt] = AllBoost(parts[has_pt], pboost[has_pt])
+    if not numpy.all(has_pt):
+        out[~has_pt] = ZBoost(parts[~has_pt], pboost[~has_pt])
+    return out
+
+
+def Rambo(ecm, masses, nevents, rng):
+    """
+    Generate nevents random phase-space points for len(masses) final-state particles with
+    total momentum (ecm, 0, 0, 0), using the RAMBO algorithm (Kleiss, Stirling, Ellis).
+    Returns an array (nevents, len(masses), 4). The points are not weighted, so this is only
+    intended for testing and benchmarking, not for integration.
+    """
+    masses = numpy.asarray(masses, dtype=numpy.float64)
+    n = len(masses)
+    if n == 1:
+        out = numpy.zeros((nevents, 1, 4))
+        out[:, 0, 0] = ecm
+        return out
+
+    # Massless momenta with isotropic directions
+    cos_t = rng.uniform(-1., 1., size=(nevents, n))
+    sin_t = numpy.sqrt(1. - cos_t**2)
+    phi = rng.uniform(0., 2. * numpy.pi, size=(nevents, n))
+    q0 = -numpy.log(rng.uniform(size=(nevents, n)) * rng.uniform(size=(nevents, n)))
+    q = numpy.stack((q0, q0 * sin_t * numpy.cos(phi), q0 * sin_t * numpy.sin(phi), q0 * cos_t), axis=-1)
+
+    # Boost and rescale them so that they sum to (ecm, 0, 0, 0)
+    Q = q.sum(axis=1)
+    M = numpy.sqrt(Q[:, 0]**2 - (Q[:, 1:]**2).sum(axis=1))
+    b = -Q[:, None, 1:] / M[:, None, None]
+    x = (ecm / M)[:, None]
+    gamma = (Q[:, 0] / M)[:, None]
+    a = 1. / (1. + gamma)
+    bq = (b * q[:, :, 1:]).sum(axis=2)
+    p = numpy.empty_like(q)
+    p[:, :, 0] = x * (gamma * q[:, :, 0] + bq)
+    p[:, :, 1:] = x[:, :, None] * (q[:, :, 1:] + b * q[:, :, 0, None] + (a * bq)[:, :, None] * b)
+
+    if not numpy.any(masses > 0.):
+        return p
+
+    # Rescale the three-momenta to put the particles on their mass shells
+    xi = numpy.full((nevents, 1), numpy.sqrt(max(1. - (masses.sum() / ecm)**2, 0.)))
+    for i in range(50):
+        e = numpy.sqrt(masses**2 + xi**2 * p[:, :, 0]**2)
+        f = e.sum(axis=1, keepdims=True) - ecm
+        df = (xi * p[:, :, 0]**2 / e).sum(axis=1, keepdims=True)
+        xi = xi - f / df
+        if numpy.all(numpy.abs(f) < 1e-10 * ecm):
+            break
+    k = numpy.empty_like(p)
+    k[:, :, 1:] = xi[:, :, None] * p[:, :, 1:]
+    k[:, :, 0] = numpy.sqrt(masses**2 + (k[:, :, 1:]**2).sum(axis=2))
+    return k
@@ -21,35 +21,30 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Plotting parameters')
     parser.add_argument('--parquet', action='store_true', help='Produce parquet file to plot')
-    parser.add_argument('--file', type=str, default='plots', help='Parquet filename')
+    parser.add_argument('--file', type=str, default='plots', help='Parquet dataset name')
     parser.add_argument('--output', type=str, default='plots', help='Output name for plots')
+    parser.add_argument('--input-glob', type=str, default='events_*_nonp.lhe', help='LHE files to convert with --parquet')
+    parser.add_argument('--parquet-dir', type=str, default='parquet_files', help='Directory for the parquet datasets')
+    parser.add_argument('--workers', type=int, default=1, help='Number of files to convert in parallel')
+    parser.add_argument('--hash', action='store_true', help='Also compare the content hash of the LHE files to decide which need to be converted again')
     args = parser.parse_args()
 
+    # Each dataset is a directory with one parquet part per LHE file
+    dataset_dir = os.path.join(args.parquet_dir, args.file+"events")
+
     if args.parquet:
-        filenames = glob.glob("/data_CMS/cms/amella/EFT2Obs/lhe_files/ggF-H-chg/events/events_*_nonp.lhe")
+        filenames = sorted(glob.glob(args.input_glob))
         total_files = len(filenames)
 
         print(f"Found {total_files} LHE files to process.")
         lhe.printProgressBar(0, total_files, prefix='Progress:', suffix='Complete', length=50)
-        arrays = []
-        for i, f in enumerate(filenames, start=1):
-            events_ind = lhe.lhe_to_awkward(f)
-            arrays.append(events_ind)
-            lhe.printProgressBar(i, total_files, prefix='Progress:', suffix='Complete', length=50)
-        events = ak.concatenate(arrays)
-
-        # events = ak.concatenate([lhe.lhe_to_awkward(f) for f in filenames])
-
-        output_dir = "/data_CMS/cms/amella/EFT2Obs/parquet_files/" 
-        os.makedirs(output_dir, exist_ok=True)
-
-        ak.to_parquet(events, os.path.join(output_dir, args.file+"events.parquet"))
+        def progress(i, total, filename, n_events):
+            lhe.printProgressBar(i, total, prefix='Progress:', suffix='Complete', length=50)
+        lhe.convert_lhe_files(filenames, dataset_dir, workers=args.workers, progress=progress, use_hash=args.hash)
 
-    parquet_dir = "/data_CMS/cms/amella/EFT2Obs/parquet_files/" 
-    if os.path.exists(parquet_dir):
-     print("Opening", parquet_dir+args.file+"events.parquet")
-     events=ak.from_parquet(parquet_dir+args.file+"events.parquet") 
-     events = ak.with_field(
+    print("Opening", dataset_dir)
+    events=lhe.read_parquet_parts(dataset_dir)
+    events = ak.with_field(
         events,
         ak.zip(
             {"px": events.p4.px, "py": events.p4.py, "pz": events.p4.pz, "E": events.p4.E},
@@ -12,9 +12,16 @@ from hist import Hist
 import numpy as np
 import matplotlib.pyplot as plt
 import mplhep as hep
+import os
+import json
+import hashlib
+from multiprocessing import Pool
 
 mpl.rcParams['figure.dpi'] = 300
 
+# Records the input file of every part in a parquet dataset directory
+MANIFEST = "manifest.json"
+
 def printProgressBar(iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
@@ -23,23 +30,33 @@ def printProgressBar(iteration, total, prefix = '', suffix = '', decimals = 1, l
     if iteration == total: 
         print()
 
-def lhe_to_awkward(filename):
+def lhe_to_awkward(filename, chunk_size=100000):
     reader = LHEReader(filename, weight_mode='dict')
 
-    # Build the event structure as an awkward array
-    events = ak.Array([
-        {
-            "px": [p.px for p in e.particles],
-            "py": [p.py for p in e.particles],
-            "pz": [p.pz for p in e.particles],
-            "E":  [p.energy for p in e.particles],
-            "pdgid": [p.pdgid for p in e.particles],
-            "status": [p.status for p in e.particles],
-            "mass": [p.mass for p in e.particles],
-            "weights": e.weights
-        }
-        for e in reader
-    ])
+    # Fill flat per-particle columns chunk by chunk, the jagged structure is only built
+    # at the end from the number of particles per event
+    columns = {"px": "px", "py": "py", "pz": "pz", "E": "energy", "pdgid": "pdgid", "status": "status", "mass": "mass"}
+    content = {name: [] for name in columns}
+    counts = []
+    weights = []
+    for chunk in reader.iter_chunks(chunk_size):
+        for name, column in columns.items():
+            content[name].append(np.ascontiguousarray(chunk.particles[column]))
+        counts.append(np.diff(chunk.offsets))
+        # Transposed, so that each weight id ends up as one contiguous column
+        weights.append(chunk.weights.T)
+    weight_ids = reader.weight_ids or []
+
+    counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+    fields = {}
+    for name in columns:
+        flat = np.concatenate(content.pop(name)) if counts.size else np.zeros(0)
+        fields[name] = ak.unflatten(flat, counts)
+    # Dense (nevents, nweights) weights as a record keyed by weight id
+    weights = np.concatenate(weights, axis=1, out=np.empty((len(weight_ids), counts.size))) if counts.size else np.zeros((len(weight_ids), 0))
+    if weight_ids:
+        fields["weights"] = ak.zip({weight_id: weights[i] for i, weight_id in enumerate(weight_ids)})
+    events = ak.zip(fields, depth_limit=1)
 
     # Adding a a new field "p4", the 4-vector of the particle in the list events as an awkward array
     vector.register_awkward()
@@ -57,6 +74,123 @@ def lhe_to_awkward(filename):
 
     return events
 
+def lhe_to_parquet(filename, output):
+    # Written under a temporary name, so that an interrupted conversion never leaves a partial part
+    events = lhe_to_awkward(filename)
+    ak.to_parquet(events, output + ".tmp")
+    os.replace(output + ".tmp", output)
+    return filename, len(events)
+
+def file_key(filename, use_hash=False):
+    '''
+    Cache key of an input file: its size and modification time, and optionally a hash of
+    its content
+    '''
+    stat = os.stat(filename)
+    key = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if use_hash:
+        digest = hashlib.sha256()
+        with open(filename, "rb") as infile:
+            for block in iter(lambda: infile.read(1 << 24), b""):
+                digest.update(block)
+        key["hash"] = digest.hexdigest()
+    return key
+
+def part_name(filename):
+    # The same file name can appear in several input directories, so the path is part of the name
+    path = os.path.abspath(filename)
+    tag = hashlib.sha256(path.encode()).hexdigest()[:12]
+    return "%s-%s.parquet" % (os.path.splitext(os.path.basename(path))[0], tag)
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(output_dir, manifest):
+    filename = os.path.join(output_dir, MANIFEST)
+    with open(filename + ".tmp", "w") as outfile:
+        json.dump(manifest, outfile, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+def convert_lhe_files(filenames, output_dir, workers=1, progress=None, use_hash=False):
+    '''
+    Convert each LHE file into its own parquet part in output_dir, so that the full dataset
+    is never held in memory. The files are processed in a pool of worker processes, and
+    progress(n_done, n_total, filename, n_events) is called as each file finishes. The
+    parts can be read back together with read_parquet_parts(output_dir). Returns the list
+    of parts in the same order as filenames.
+
+    output_dir also acts as a cache: a manifest records the key (see file_key) of the
+    input of every part, and only new or changed files are converted again. Parts of
+    files that are no longer in filenames are removed.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    paths = [os.path.abspath(f) for f in filenames]
+    parts = [os.path.join(output_dir, part_name(path)) for path in paths]
+    pool = Pool(processes=workers) if workers > 1 else None
+    try:
+        key_jobs = [(path, use_hash) for path in paths]
+        keys = dict(zip(paths, pool.map(_file_key_job, key_jobs) if pool is not None else map(_file_key_job, key_jobs)))
+
+        # Evict the parts of inputs that were removed or changed, and anything else left over
+        jobs = []
+        for path in list(manifest):
+            if path not in keys or manifest[path]["key"] != keys[path]:
+                del manifest[path]
+        for path, part in zip(paths, parts):
+            if path not in manifest or not os.path.exists(part):
+                manifest.pop(path, None)
+                jobs.append((path, part))
+        keep = set(os.path.basename(part) for part in parts) | set([MANIFEST])
+        for name in os.listdir(output_dir):
+            if name not in keep and (name.endswith(".parquet") or name.endswith(".tmp")):
+                os.remove(os.path.join(output_dir, name))
+        save_manifest(output_dir, manifest)
+
+        n_done = 0
+        for path in paths:
+            if path in manifest:
+                n_done += 1
+                if progress is not None:
+                    progress(n_done, len(paths), path, manifest[path]["events"])
+
+        if pool is not None:
+            results = pool.imap_unordered(_lhe_to_parquet_job, jobs)
+        else:
+            results = map(_lhe_to_parquet_job, jobs)
+        part_of = dict(jobs)
+        for path, n_events in results:
+            manifest[path] = {"key": keys[path], "part": os.path.basename(part_of[path]), "events": n_events}
+            save_manifest(output_dir, manifest)
+            n_done += 1
+            if progress is not None:
+                progress(n_done, len(paths), path, n_events)
+        save_manifest(output_dir, {path: manifest[path] for path in paths})
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return parts
+
+def read_parquet_parts(output_dir):
+    '''
+    Read back the parts written by convert_lhe_files, in the order of the input files
+    '''
+    manifest = load_manifest(output_dir)
+    if not manifest:
+        raise RuntimeError('No parquet parts in %s, run convert_lhe_files first' % output_dir)
+    return ak.from_parquet([os.path.join(output_dir, entry["part"]) for entry in manifest.values()])
+
+def _file_key_job(job):
+    return file_key(*job)
+
+def _lhe_to_parquet_job(job):
+    return lhe_to_parquet(*job)
+
 def abs_delta_phi(phi1, phi2):
     dphi = np.abs(phi1 - phi2)
     dphi = ak.where(dphi > np.pi, 2 * np.pi - dphi, dphi)
@@ -0,0 +1,105 @@
+"""
+Benchmark the evaluation modes of StandaloneReweight on a standalone reweighting directory
+(see make_standalone.py).
+
+ - mode 0: one copy of the matrix element library is loaded per reweight point
+ - mode 1: the library is loaded once and the parameter common blocks are restored from a
+           cache before each evaluation
+
+Each mode is run in a separate process, so that the initialisation time and resident memory
+are measured independently. Random phase-space points are generated for each subprocess
+of the library, and the same points are used for all modes. The weights from each mode are
+compared to those from the first mode in the list.
+
+To run do:
+  python scripts/rw_benchmark.py rw_zh-SMEFTsim3 --events 500 --modes 0,1
+"""
+from __future__ import print_function
+
+import sys
+import os
+import json
+import time
+import resource
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+
+
+def maxRSS():
+  """Peak resident memory of this process in MB"""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def runMode(args):
+  import standalone_reweight
+
+  t0 = time.time()
+  rw = standalone_reweight.StandaloneReweight(args.module, mode=args.run_mode)
+  t_init = time.time() - t0
+  rss_init = maxRSS()
+
+  rng = np.random.default_rng(args.seed)
+  n_sub = len(rw.all_pdgs)
+  batches = [rw.RandomEvents(idx, args.events // n_sub + (idx < args.events % n_sub), rng) for idx in range(n_sub)]
+  n_events = sum(len(batch[0]) for batch in batches)
+
+  t0 = time.time()
+  weights = [rw.ComputeWeightsBatch(parts, pdgs, hels, stats, args.alphas, dohelicity=False) for parts, pdgs, hels, stats in batches]
+  t_run = time.time() - t0
+
+  np.save(args.save_weights, np.concatenate(weights))
+  return {
+    'mode': args.run_mode,
+    'points': rw.N,
+    'events': n_events,
+    'init_time': t_init,
+    'events_per_s': n_events / t_run,
+    'me_calls_per_s': n_events * rw.N / t_run,
+    'rss_init_mb': rss_init,
+    'rss_max_mb': maxRSS()
+  }
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('module', help="Standalone reweighting directory")
+  parser.add_argument('--modes', default='0,1', help="Comma separated list of modes to benchmark")
+  parser.add_argument('--events', type=int, default=200, help="Number of events to reweight in each mode")
+  parser.add_argument('--alphas', type=float, default=0.118)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--json', default=None, help="Also save the results to this json file")
+  # Used internally to run a single mode in a subprocess
+  parser.add_argument('--run-mode', type=int, default=None, help=argparse.SUPPRESS)
+  parser.add_argument('--save-weights', default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run_mode is not None:
+    result = runMode(args)
+    print('RESULT ' + json.dumps(result))
+    sys.exit(0)
+
+  results = []
+  ref_weights = None
+  tmpdir = tempfile.mkdtemp()
+  for mode in [int(X) for X in args.modes.split(',')]:
+    print('>> Running mode %i' % mode)
+    wt_file = os.path.join(tmpdir, 'weights_mode%i.npy' % mode)
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), args.module,
+                                      '--events', str(args.events), '--alphas', str(args.alphas), '--seed', str(args.seed),
+                                      '--run-mode', str(mode), '--save-weights', wt_file]).decode()
+    result = json.loads([line for line in output.splitlines() if line.startswith('RESULT ')][-1][len('RESULT '):])
+    weights = np.load(wt_file)
+    os.remove(wt_file)
+    if ref_weights is None:
+      ref_weights = weights
+    result['max_rel_diff'] = float(np.nanmax(np.abs(weights - ref_weights) / np.maximum(np.abs(ref_weights), 1e-300)))
+    results.append(result)
+  os.rmdir(tmpdir)
+
+  print('%-6s %-8s %-8s %-12s %-12s %-14s %-14s %-12s' % ('mode', 'points', 'events', 'init [s]', 'events/s', 'RSS init [MB]', 'RSS max [MB]', 'max rel diff'))
+  for r in results:
+    print('%-6i %-8i %-8i %-12.2f %-12.2f %-14.1f %-14.1f %-12.3g' % (r['mode'], r['points'], r['events'], r['init_time'], r['events_per_s'], r['rss_init_mb'], r['rss_max_mb'], r['max_rel_diff']))
+
+  if args.json is not None:
+    with open(args.json, 'w') as outfile:
+      json.dump(results, outfile, indent=2)
@@ -11,10 +11,15 @@ if they are the same based upon a threshold that is 1% as default. It will print
 the fraction of events that fail at the end.
 
 To run do:
-  python scripts/rw_module_tester.py my_lhe_file.lhe my_rw_module <VERB>
+  python scripts/rw_module_tester.py my_lhe_file.lhe my_rw_module <VERB> <SHARD>
 <VERB> = 0 -> Minimal output
 <VERB> = 1 -> Prints out event that fail
 <VERB> = 2 -> Prints out all events
+<SHARD> = i/N -> Only test the i-th of N equal parts of the file (counting from 0), e.g.
+                 to split the validation of a large file over several jobs
+
+A failing event can be looked at again directly with:
+  python scripts/lhe_interface.py my_lhe_file.lhe <number of reweights> <event number>
 """
 from __future__ import print_function
 
@@ -23,13 +28,13 @@ from builtins import str
 from builtins import range
 import sys
 import lhe_interface
+import lhe_stream
 import numpy as np
 import imp
 import standalone_reweight
 
-def weightsSame(event, rw, fromfile_weights_gen, threshold=0.01, VERB=0):
+def weightsSame(event, rw, fromfile_weights, threshold=0.01, VERB=0):
   calculated_weights = event.getReweights(rw)
-  fromfile_weights = next(fromfile_weights_gen)
 
   passed = True
   for i in range(len(calculated_weights)):
@@ -40,12 +45,14 @@ def weightsSame(event, rw, fromfile_weights_gen, threshold=0.01, VERB=0):
       break
 
   if (VERB==1) and not passed:
+    print("Event %i" % event.event_id)
     print(event)
     print("Passed: " + str(passed))
     print("Calculated weights: " + str(calculated_weights))
     print("From file weights: " + str(fromfile_weights))
     print("")
   elif (VERB>=2):
+    print("Event %i" % event.event_id)
     print(event)
     print("Passed: " + str(passed))
     print("Calculated weights: " + str(calculated_weights))
@@ -62,17 +69,22 @@ if __name__=="__main__":
   except:
     VERB = 0
 
+  start, stop = 0, None
+  if len(sys.argv) > 4:
+    shard, n_shards = [int(X) for X in sys.argv[4].split('/')]
+    with lhe_stream.LHEReader(filename) as reader:
+      start, stop = lhe_stream.ShardRanges(len(reader), n_shards)[shard]
+
   rw = standalone_reweight.StandaloneReweight(process)
 
-  events = lhe_interface.getEvents(filename)
-  fromfile_weights_gen = lhe_interface.getReweightsFromFile(filename, rw.N, True)
+  events = lhe_interface.getEventsAndReweights(filename, rw.N, True, start, stop)
 
   no_events = 0
   no_failed = 0
 
-  for event in events:
+  for event, fromfile_weights in events:
     no_events += 1
-    if not weightsSame(event, rw, fromfile_weights_gen, 0.01, VERB):
+    if not weightsSame(event, rw, fromfile_weights, 0.01, VERB):
       no_failed += 1
 
   print("Fraction failed:%f" %(float(no_failed)/float(no_events)))
@@ -0,0 +1,283 @@
+"""
+Long-lived reweighting server. The rw pack (see make_standalone.py) is loaded once and batches
+of events are reweighted on request over a Unix domain socket, so that jobs that only process
+a few events do not each pay the initialisation cost of StandaloneReweight.
+
+To start the server do:
+  python scripts/rw_server.py serve --module rw_zh-SMEFTsim3 --socket /tmp/rw_zh.sock
+
+and from python:
+  from rw_server import ReweightClient
+  with ReweightClient('/tmp/rw_zh.sock') as client:
+    info = client.Info()
+    weights = client.ComputeWeightsBatch(parts, pdgs, hels, stats, alphas)
+
+where the arguments and the returned (nevents, N) array are as for
+StandaloneReweight.ComputeWeightsBatch. The server is stopped with SIGINT/SIGTERM, with
+client.Shutdown() or with:
+  python scripts/rw_server.py stop --socket /tmp/rw_zh.sock
+
+The round trip through the socket can be checked against StandaloneReweight directly with:
+  python scripts/rw_server.py check --module rw_zh-SMEFTsim3 --socket /tmp/rw_check.sock --input events.lhe
+which starts a temporary server, compares its info and the weights of the first --events events
+with those computed in the same process, and stops it again.
+
+Messages in both directions are a header struct '<BQ' (command or status, payload length)
+followed by the payload. A weights request payload is a header '<IIB' (nevents, nparticles,
+dohelicity) followed by the arrays parts (float64, nevents x nparticles x 4), pdgs, hels and
+stats (int32, nevents x nparticles) and alphas (float64, nevents). The reply is '<II' (nevents,
+N) followed by the float64 weights. Info replies are json. On an error the status is 1 and the
+payload is the error message.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+import struct
+import signal
+import argparse
+import itertools
+import threading
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+import numpy as np
+
+CMD_WEIGHTS = 1
+CMD_INFO = 2
+CMD_SHUTDOWN = 3
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+FRAME = struct.Struct('<BQ')
+WEIGHTS_REQUEST = struct.Struct('<IIB')
+WEIGHTS_REPLY = struct.Struct('<II')
+
+
+def recvExact(sock, n):
+  """Read exactly n bytes, returns None if the connection is closed before any are read"""
+  buf = bytearray(n)
+  view = memoryview(buf)
+  pos = 0
+  while pos < n:
+    nread = sock.recv_into(view[pos:])
+    if nread == 0:
+      if pos == 0:
+        return None
+      raise ConnectionError('Connection closed in the middle of a message')
+    pos += nread
+  return bytes(buf)
+
+def sendMessage(sock, code, payload=b''):
+  sock.sendall(FRAME.pack(code, len(payload)) + payload)
+
+def recvMessage(sock):
+  header = recvExact(sock, FRAME.size)
+  if header is None:
+    return None, None
+  code, length = FRAME.unpack(header)
+  return code, recvExact(sock, length) if length > 0 else b''
+
+def packWeightsRequest(parts, pdgs, hels, stats, alphas, dohelicity=True):
+  parts = np.ascontiguousarray(parts, dtype='<f8')
+  nevents, nparts = parts.shape[:2]
+  alphas = np.broadcast_to(np.asarray(alphas, dtype='<f8'), (nevents,))
+  arrays = [parts] + [np.ascontiguousarray(X, dtype='<i4') for X in (pdgs, hels, stats)] + [np.ascontiguousarray(alphas)]
+  for X in arrays[1:4]:
+    assert X.shape == (nevents, nparts)
+  return WEIGHTS_REQUEST.pack(nevents, nparts, bool(dohelicity)) + b''.join(X.tobytes() for X in arrays)
+
+def unpackWeightsRequest(payload):
+  nevents, nparts, dohelicity = WEIGHTS_REQUEST.unpack_from(payload)
+  offset = WEIGHTS_REQUEST.size
+  out = []
+  for dtype, shape in [('<f8', (nevents, nparts, 4)), ('<i4', (nevents, nparts)), ('<i4', (nevents, nparts)), ('<i4', (nevents, nparts)), ('<f8', (nevents,))]:
+    count = int(np.prod(shape))
+    out.append(np.frombuffer(payload, dtype=dtype, count=count, offset=offset).reshape(shape))
+    offset += count * np.dtype(dtype).itemsize
+  if offset != len(payload):
+    raise ValueError('Malformed weights request')
+  return out + [bool(dohelicity)]
+
+
+class ReweightHandler(socketserver.BaseRequestHandler):
+  """Serves the requests of one client connection until it disconnects"""
+
+  def handle(self):
+    server = self.server
+    while True:
+      code, payload = recvMessage(self.request)
+      if code is None:
+        return
+      try:
+        if code == CMD_WEIGHTS:
+          parts, pdgs, hels, stats, alphas, dohelicity = unpackWeightsRequest(payload)
+          # The matrix element libraries are not thread safe
+          with server.lock:
+            weights = server.rw.ComputeWeightsBatch(parts, pdgs, hels, stats, alphas, dohelicity)
+          reply = WEIGHTS_REPLY.pack(*weights.shape) + np.ascontiguousarray(weights, dtype='<f8').tobytes()
+        elif code == CMD_INFO:
+          reply = json.dumps(server.Info()).encode()
+        elif code == CMD_SHUTDOWN:
+          sendMessage(self.request, STATUS_OK)
+          server.Stop()
+          return
+        else:
+          raise ValueError('Unknown command %i' % code)
+      except Exception as e:
+        sendMessage(self.request, STATUS_ERROR, ('%s: %s' % (type(e).__name__, e)).encode())
+        continue
+      sendMessage(self.request, STATUS_OK, reply)
+
+
+class ReweightServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """Unix socket server that owns one StandaloneReweight instance"""
+  daemon_threads = True
+
+  def __init__(self, socket_path, rw):
+    self.rw = rw
+    self.lock = threading.Lock()
+    self.socket_path = socket_path
+    if os.path.exists(socket_path):
+      # Only remove the socket of a server that is no longer running
+      try:
+        ReweightClient(socket_path).Close()
+        raise RuntimeError('A server is already listening on %s' % socket_path)
+      except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(socket_path)
+    socketserver.UnixStreamServer.__init__(self, socket_path, ReweightHandler)
+    os.chmod(socket_path, 0o600)
+
+  def Info(self):
+    return {
+      'pid': os.getpid(),
+      'module': self.rw.target_dir,
+      'pars': self.rw.pars,
+      'N': int(self.rw.N),
+      # The PDG codes come from the matrix element library as numpy integers
+      'active': [int(iw) for iw in self.rw.active],
+      'pdgs': [[int(pdg) for pdg in pdgs] for pdgs in self.rw.all_pdgs],
+      'prefix': [str(prefix) for prefix in self.rw.all_prefix]
+    }
+
+  def Stop(self):
+    # shutdown() waits for serve_forever to return, so it can't be called from the same thread
+    threading.Thread(target=self.shutdown).start()
+
+  def server_close(self):
+    socketserver.UnixStreamServer.server_close(self)
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+
+
+class ReweightClient(object):
+  """Thin client for ReweightServer"""
+
+  def __init__(self, socket_path, timeout=None):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    try:
+      self.sock.connect(socket_path)
+    except Exception:
+      self.sock.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def Request(self, code, payload=b''):
+    sendMessage(self.sock, code, payload)
+    status, reply = recvMessage(self.sock)
+    if status is None:
+      raise ConnectionError('Server closed the connection')
+    if status != STATUS_OK:
+      raise RuntimeError('Reweight server error: %s' % reply.decode())
+    return reply
+
+  def Info(self):
+    return json.loads(self.Request(CMD_INFO).decode())
+
+  def ComputeWeightsBatch(self, parts, pdgs, hels, stats, alphas, dohelicity=True):
+    reply = self.Request(CMD_WEIGHTS, packWeightsRequest(parts, pdgs, hels, stats, alphas, dohelicity))
+    nevents, npoints = WEIGHTS_REPLY.unpack_from(reply)
+    return np.frombuffer(reply, dtype='<f8', offset=WEIGHTS_REPLY.size).reshape(nevents, npoints).copy()
+
+  def Shutdown(self):
+    self.Request(CMD_SHUTDOWN)
+    self.Close()
+
+  def Close(self):
+    self.sock.close()
+
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('action', choices=['serve', 'stop', 'info', 'check'])
+  parser.add_argument('--socket', required=True, help="Path of the Unix domain socket")
+  parser.add_argument('--module', default='.', help="Standalone reweighting directory")
+  parser.add_argument('--mode', type=int, default=0, choices=[0, 1])
+  parser.add_argument('--cache-dir', default=None)
+  parser.add_argument('--pars', default=None, help="Comma separated list of parameters to reweight, default is all in the config")
+  parser.add_argument('--terms', default=None, help="Comma separated list of the terms to compute: linear,square,cross (default all)")
+  parser.add_argument('--skip-sm-points', action='store_true')
+  parser.add_argument('--me-log', default=None)
+  parser.add_argument('--input', default=None, help="LHE file with the events used by check")
+  parser.add_argument('--events', type=int, default=100, help="Number of events used by check")
+  args = parser.parse_args()
+
+  if args.action == 'stop':
+    ReweightClient(args.socket).Shutdown()
+    sys.exit(0)
+  if args.action == 'info':
+    with ReweightClient(args.socket) as client:
+      print(json.dumps(client.Info(), indent=2))
+    sys.exit(0)
+
+  from standalone_reweight import StandaloneReweight
+  rw = StandaloneReweight(args.module, mode=args.mode, cache_dir=args.cache_dir,
+                          pars=args.pars.split(',') if args.pars is not None else None,
+                          terms=args.terms.split(',') if args.terms is not None else None,
+                          skip_sm_points=args.skip_sm_points)
+  server = ReweightServer(args.socket, rw)
+  if args.action == 'check':
+    import lhe_stream
+    from standalone_reweight import StackEvents
+    reader = lhe_stream.LHEReader(args.input)
+    events = [event.Info() for event in itertools.islice(reader, args.events)]
+    reader.Close()
+    with rw.Session(log=args.me_log):
+      thread = threading.Thread(target=server.serve_forever)
+      thread.start()
+      try:
+        with ReweightClient(args.socket) as client:
+          info = client.Info()
+          weights = client.ComputeWeightsBatch(*StackEvents(events))
+        expected = rw.ComputeWeightsBatch(*StackEvents(events))
+      finally:
+        server.Stop()
+        thread.join()
+        server.server_close()
+    info_ok = info == server.Info()
+    max_diff = np.nanmax(np.abs(weights - expected)) if weights.size else 0.
+    weights_ok = np.array_equal(np.isnan(weights), np.isnan(expected)) and max_diff == 0.
+    print('>> Info round trip: %s' % ('OK' if info_ok else 'FAILED'))
+    print('>> Weights of %i events: max difference %g, %s' % (len(events), max_diff, 'OK' if weights_ok else 'FAILED'))
+    sys.exit(0 if info_ok and weights_ok else 1)
+  for sig in [signal.SIGINT, signal.SIGTERM]:
+    signal.signal(sig, lambda signum, frame: server.Stop())
+  print('>> Serving %s on %s' % (rw.target_dir, args.socket))
+  sys.stdout.flush()
+  # The Fortran output stays redirected for the lifetime of the server
+  with rw.Session(log=args.me_log):
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
+  print('>> Server stopped')
@@ -5,16 +5,23 @@ from builtins import range
 from builtins import object
 import sys
 import os
-import ROOT
 import subprocess
 import argparse
 import math
 import json
 import numpy
 import copy
-import importlib
-from glob import glob
+import ctypes
+import hashlib
+import socket
+import threading
+import time
+import traceback
+import importlib.util
+from glob import glob, escape
 from collections import defaultdict
+import lorentz_kernels
+import lhe_stream
 
 
 def GetConfigFile(filename):
@@ -27,6 +34,134 @@ def GetConfigFile(filename):
                 p[k] = cfg['parameter_defaults'][k]
     return cfg
 
+def GetNumPoints(Npars):
+    """Number of reweight points for Npars parameters: SM, two per parameter and one per pair"""
+    return int(1 + Npars * 2 + (Npars * Npars - Npars) / 2)
+
+def MemoryRegions(arrays):
+    """
+    Return writable uint8 views covering the memory of a list of arrays. The arrays of one
+    Fortran common block are laid out contiguously, so normally a single view spanning all
+    of them is returned. If the arrays turn out not to be close together in memory, one
+    view per array is returned instead.
+    """
+    arrays = [X for X in arrays if X.nbytes > 0]
+    if not arrays:
+        return []
+    starts = [X.__array_interface__['data'][0] for X in arrays]
+    ends = [start + X.nbytes for start, X in zip(starts, arrays)]
+    total = sum(X.nbytes for X in arrays)
+    lo, hi = min(starts), max(ends)
+    assert all(X.flags['C_CONTIGUOUS'] or X.flags['F_CONTIGUOUS'] for X in arrays)
+    # Allow for alignment padding between the members of the block
+    if (hi - lo) <= total + 16 * len(arrays):
+        return [numpy.ctypeslib.as_array((ctypes.c_uint8 * (hi - lo)).from_address(lo))]
+    return [numpy.ctypeslib.as_array((ctypes.c_uint8 * X.nbytes).from_address(start)) for start, X in zip(starts, arrays)]
+
+def ActivePoints(all_pars, pars=None, terms=None):
+    """Sorted list of the reweight points needed for a subset of parameters and term types, see StandaloneReweight.SelectPoints"""
+    Npars = len(all_pars)
+    if pars is None:
+        pars = all_pars
+    if terms is None:
+        terms = ['linear', 'square', 'cross']
+    for par in pars:
+        if par not in all_pars:
+            raise ValueError('Parameter %s is not in the config, choose from %s' % (par, all_pars))
+    for term in terms:
+        if term not in ['linear', 'square', 'cross']:
+            raise ValueError('Unknown term type %s, choose from linear, square, cross' % term)
+
+    selected = [ip for ip in range(Npars) if all_pars[ip] in pars]
+    active = set([0])
+    if 'linear' in terms or 'square' in terms:
+        for ip in selected:
+            active.update([ip * 2 + 1, ip * 2 + 2])
+    if 'cross' in terms:
+        crossed_offset = 1 + 2 * Npars
+        c_counter = 0
+        for ix in range(0, Npars):
+            for iy in range(ix + 1, Npars):
+                if ix in selected and iy in selected:
+                    active.update([crossed_offset + c_counter, ix * 2 + 2, iy * 2 + 2])
+                c_counter += 1
+    return sorted(active)
+
+def MaskedDot(X, A):
+    """
+    Return X @ A.T, where X may contain NaN values (e.g. for reweight points that were not
+    selected). An output is only NaN if it depends on a NaN input, i.e. where A is non-zero.
+    """
+    isnan = numpy.isnan(X)
+    out = numpy.where(isnan, 0., X) @ A.T
+    if numpy.any(isnan):
+        out[isnan @ (A != 0).T] = numpy.nan
+    return out
+
+def EncodeHelicities(hels):
+    """
+    Pack helicity configurations into integers, one base-3 digit (h + 1) per particle.
+    hels has shape (..., nparticles). Configurations containing values other than -1, 0
+    or 1 are encoded as -1, which never matches a valid configuration.
+    """
+    hels = numpy.rint(numpy.asarray(hels, dtype=numpy.float64))
+    if hels.shape[-1] > 39:
+        raise ValueError('Too many particles (%i) to encode the helicities in 64 bits' % hels.shape[-1])
+    digits = numpy.where(numpy.isnan(hels), -1, hels).astype(numpy.int64) + 1
+    codes = digits @ (3 ** numpy.arange(hels.shape[-1], dtype=numpy.int64))
+    valid = numpy.all((hels >= -1) & (hels <= 1), axis=-1)
+    return numpy.where(valid, codes, -1)
+
+def HelicityTable(hel_dict):
+    """
+    Convert a helicity dict {(h1, h2, ...): nhel} into a pair of arrays (codes, nhels),
+    sorted by code, for use with LookupHelicities
+    """
+    if len(hel_dict) == 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    codes = EncodeHelicities(list(hel_dict.keys()))
+    nhels = numpy.array(list(hel_dict.values()), dtype=numpy.int64)
+    order = numpy.argsort(codes, kind='stable')
+    return codes[order], nhels[order]
+
+def LookupHelicities(table, hels):
+    """
+    Find the nhel index for each helicity configuration in hels (..., nparticles) with a
+    single searchsorted on the encoded configurations. Returns -1 where the configuration
+    is not in the table, i.e. the sum over all helicities should be used.
+    """
+    codes, nhels = table
+    evt_codes = EncodeHelicities(hels)
+    if len(codes) == 0:
+        return numpy.full(evt_codes.shape, -1, dtype=numpy.int64)
+    pos = numpy.minimum(numpy.searchsorted(codes, evt_codes), len(codes) - 1)
+    return numpy.where((codes[pos] == evt_codes) & (evt_codes >= 0), nhels[pos], -1)
+
+def FileHash(filename):
+    """Short hash of the contents of a file"""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+def CachedCopy(src, dest):
+    """
+    Copy src to dest, unless dest already exists. The copy is written under a temporary
+    name and then renamed, so concurrent jobs never see a partial file, and a file that
+    another process has already loaded is never modified. A reflink is used where the
+    filesystem supports it. Hardlinks cannot be used: the dynamic loader identifies
+    libraries by inode, so all the links would share one set of common blocks.
+    Returns True if a new copy was made.
+    """
+    if os.path.isfile(dest) and os.path.getsize(dest) == os.path.getsize(src):
+        return False
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = '%s.%s.%i.tmp' % (dest, socket.gethostname(), os.getpid())
+    subprocess.check_call(['cp', '--reflink=auto', src, tmp])
+    os.replace(tmp, dest)
+    return True
+
 import contextlib
 #from MadGraph misc.py, useful for supressing output
 @contextlib.contextmanager
@@ -55,12 +190,170 @@ def stdchannel_redirected(stdchannel, dest_filename):
             dest_file.close()
 
 
+class ReweightSession(object):
+    """
+    Context manager that redirects the stdout file descriptor, where the Fortran and MadLoop
+    output goes, for its whole lifetime instead of around each matrix element call. Python
+    output stays visible: if sys.stdout writes to descriptor 1 it is pointed at a duplicate of
+    the original descriptor for the session, otherwise (e.g. in a notebook) it is left alone.
+    By default the Fortran output is discarded. If log is given it is written to that file,
+    with at most max_lines lines per interval seconds. A count of the dropped lines is
+    written instead of the rest.
+    """
+
+    def __init__(self, rw=None, log=None, max_lines=100, interval=60.):
+        self.rw = rw
+        self.log = log
+        self.max_lines = max_lines
+        self.interval = interval
+        self.thread = None
+
+    def __enter__(self):
+        sys.stdout.flush()
+        self.fd = 1
+        self.saved_fd = os.dup(self.fd)
+        if self.log is None:
+            dest_fd = os.open(os.devnull, os.O_WRONLY)
+        else:
+            read_fd, dest_fd = os.pipe()
+            self.thread = threading.Thread(target=self.WriteLog, args=(read_fd,))
+            self.thread.daemon = True
+            self.thread.start()
+        os.dup2(dest_fd, self.fd)
+        os.close(dest_fd)
+        self.old_stdout = None
+        self.new_stdout = None
+        try:
+            swap_stdout = sys.stdout.fileno() == self.fd
+        except (AttributeError, ValueError):
+            swap_stdout = False
+        if swap_stdout:
+            self.old_stdout = sys.stdout
+            self.new_stdout = sys.stdout = os.fdopen(os.dup(self.saved_fd), 'w', buffering=1)
+        if self.rw is not None:
+            self.rw.session = self
+        return self
+
+    def __exit__(self, *args):
+        if self.rw is not None:
+            self.rw.session = None
+        if self.new_stdout is not None:
+            self.new_stdout.close()
+            if sys.stdout is self.new_stdout:
+                sys.stdout = self.old_stdout
+            self.new_stdout = self.old_stdout = None
+        os.dup2(self.saved_fd, self.fd)
+        os.close(self.saved_fd)
+        if self.thread is not None:
+            # Restoring the descriptor closed the write end of the pipe, so the log thread finishes
+            self.thread.join()
+            self.thread = None
+
+    def WriteLog(self, read_fd):
+        with os.fdopen(read_fd, 'r', errors='replace') as pipe, open(self.log, 'a') as logfile:
+            window_start = time.time()
+            nlines = 0
+            nsuppressed = 0
+            for line in pipe:
+                now = time.time()
+                if now - window_start > self.interval:
+                    if nsuppressed > 0:
+                        logfile.write('[%i lines suppressed]\n' % nsuppressed)
+                    window_start = now
+                    nlines = 0
+                    nsuppressed = 0
+                if nlines < self.max_lines:
+                    logfile.write(line)
+                    logfile.flush()
+                    nlines += 1
+                else:
+                    nsuppressed += 1
+            if nsuppressed > 0:
+                logfile.write('[%i lines suppressed]\n' % nsuppressed)
+
+
+class ReweightMonitor(object):
+    """
+    Counters and optional timing for StandaloneReweight. The counters (events per subprocess,
+    unmatched events per PDG list and helicity configurations that were not found per
+    subprocess) are always kept. If timing is True the wall time is also recorded for the
+    PDG matching, for the boosts per subprocess and for the matrix element calls per
+    subprocess and reweight point. Summary() returns everything as a json-compatible dict.
+    """
+
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.counters = defaultdict(int)
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        # Counter keys seen so far, kept by Reset so the first occurrence is only reported once
+        self.reported = set()
+
+    def Count(self, name, key, n=1):
+        """Increment a counter, returns True if this is the first time it is incremented"""
+        first = (name, key) not in self.reported
+        self.reported.add((name, key))
+        self.counters[(name, key)] += n
+        return first
+
+    def AddTime(self, step, prefix, point, dt, n=1):
+        self.times[(step, prefix, point)] += dt
+        self.calls[(step, prefix, point)] += n
+
+    def Merge(self, other):
+        for key, val in other.counters.items():
+            self.counters[key] += val
+        for key, val in other.times.items():
+            self.times[key] += val
+        for key, val in other.calls.items():
+            self.calls[key] += val
+
+    def Reset(self):
+        """Clear the counters and timing, the keys that were already reported are kept"""
+        self.counters.clear()
+        self.times.clear()
+        self.calls.clear()
+
+    def Summary(self):
+        out = {'counters': {}, 'timing': {}}
+        for (name, key), val in sorted(self.counters.items()):
+            out['counters'].setdefault(name, {})[key] = val
+        for (step, prefix, point) in sorted(self.times, key=str):
+            entry = {'calls': self.calls[(step, prefix, point)], 'time': self.times[(step, prefix, point)]}
+            if prefix is None:
+                out['timing'][step] = entry
+            elif point is None:
+                out['timing'].setdefault(step, {})[prefix] = entry
+            else:
+                out['timing'].setdefault(step, {}).setdefault(prefix, {})['rw%.4i' % point] = entry
+        return out
+
+    def PrintCounters(self):
+        for (name, key), val in sorted(self.counters.items()):
+            if name == 'unmatched':
+                print('>> %i events with PDGs %s did not match any known process' % (val, key))
+            elif name == 'helicity_not_found':
+                print('>> %i events in subprocess %s had a helicity configuration that was not found, used -1' % (val, key))
+
+
 class StandaloneReweight(object):
 
-    def __init__(self, rw_pack, no_match_behaviour='sm weights'):
-        self.mode = 0
-        self.references = {}
-        self.caches = {}
+    def __init__(self, rw_pack, no_match_behaviour='sm weights', mode=0, cache_dir=None, pars=None, terms=None, timing=False, skip_sm_points=False):
+        """Choose how the reweight points are evaluated
+        mode = 0 -> load one copy of the matrix element library per reweight point
+        mode = 1 -> load the library once and restore the parameter common blocks
+                    (couplings, masses, widths, ...) from a snapshot before each evaluation
+        In mode 0 the library copies are kept in cache_dir, by default the SubProcesses
+        directory of the rw pack, and reused by later instances.
+        pars and terms select a subset of the reweight points, see SelectPoints.
+        timing = True records the time spent in each step, see ReweightMonitor.
+        skip_sm_points = True skips the matrix element calls for points that are found to
+        have no effect on a subprocess, see ProbeSMPoints."""
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.session = None
+        self.monitor = ReweightMonitor(timing)
+        self.caches = None
         self.tocache = ['couplings', 'weak', 'rscale', 'strong', 'masses', 'widths']
 
         """Decide what to do when given particles do not match rw module
@@ -76,9 +369,11 @@ class StandaloneReweight(object):
         self.parVals = [X['val'] for X in self.cfg['parameters']]
         self.pars = [X['name'] for X in self.cfg['parameters']]
 
-        self.N = int(1 + self.Npars * 2 + (self.Npars * self.Npars - self.Npars) / 2)
+        self.N = GetNumPoints(self.Npars)
+        self.transform_matrix = self.BuildTransformMatrix()
 
-        print('>> %i parameters, %i reweight points' % (self.Npars, self.N))
+        self.SelectPoints(pars, terms)
+        print('>> %i parameters, %i reweight points, %i selected' % (self.Npars, self.N, len(self.active)))
         self.checkNLO()
         if self.nlo:
             print(">> NLO Reweighting")
@@ -87,7 +382,6 @@ class StandaloneReweight(object):
         print(">> Initialising modules...")
         self.InitModules()
 
-        rw_me = self.mods[0]
         rw_me = self.full_mod
         ## The following code adapted from Madgraph, rweight_interface.py: L1770
         self.all_pdgs = [[pdg for pdg in pdgs if pdg!=0] for pdgs in rw_me.get_pdg_order()[0]]
@@ -109,11 +403,23 @@ class StandaloneReweight(object):
                 for i,line in enumerate(open(os.path.join(self.target_dir, 'rwgt', self.onedir, 'SubProcesses', 'MadLoop5_resources', '%sHelConfigs.dat' % prefix.upper()))):
                     onehel = [int(h) for h in line.split()]
                     self.hel_dict[prefix][tuple(onehel)] = i+1
+        # Integer-encoded copy of the helicity dicts for batches of events
+        self.hel_tables = {prefix: HelicityTable(hel_dict) for prefix, hel_dict in self.hel_dict.items()}
 
         self.setNinitsFromPdgList()
         self.sorted_pdgs = []
         for pdglist in self.all_pdgs:
             self.sorted_pdgs.append(self.SortPDGs(pdglist))
+        # Index from sorted pdg list to the first subprocess that provides it, and a cache of
+        # the event layouts that have already been matched (see MatchLayout)
+        self.sorted_pdg_index = {}
+        for idx, sorted_pdgs in enumerate(self.sorted_pdgs):
+            self.sorted_pdg_index.setdefault(tuple(sorted_pdgs), idx)
+        self.layout_cache = {}
+        # Reweight points that are known to give the SM result for each subprocess
+        self.sm_points = {}
+        if skip_sm_points:
+            self.ProbeSMPoints()
 
         print('>> StandaloneReweight class initialized')
         print('>> Accepted PDG lists:')
@@ -147,8 +453,10 @@ class StandaloneReweight(object):
 
         subproc_dir = os.path.join(self.target_dir, 'rwgt', self.onedir, 'SubProcesses')
         sys.path.append(subproc_dir)
+        self.subproc_dir = subproc_dir
         self.full_mod = None
-        self.mods = []
+        self.mods = [None] * self.N
+        self.initialised = set()
         # if "allmatrix2py" in sys.modules:
         #     del sys.modules["allmatrix2py"]
         matrix3 = glob(os.path.join(subproc_dir, "all_matrix3py*.so"))
@@ -161,6 +469,8 @@ class StandaloneReweight(object):
             full_mod_name = "allmatrix2py"
             module_lib = os.path.basename(glob(os.path.join(subproc_dir, "all_matrix2py*.so"))[0])
             internal_mod_name = 'all_matrix2py'
+        self.module_lib = module_lib
+        self.internal_mod_name = internal_mod_name
 
         if self.mode == 0:
             """
@@ -175,83 +485,200 @@ class StandaloneReweight(object):
             """
             os.chdir(subproc_dir)
             self.full_mod = importlib.import_module(full_mod_name)
-            for i in range(int(self.N)):
-                try:
-                    os.mkdir('rwdir_%i' % i)
-                except:
-                    pass
-                subprocess.check_call(['cp', module_lib, 'rwdir_%i/%s' % (i, module_lib)])
+            # The copies are kept in a directory named after the hash of the library, so they
+            # can be reused by later jobs as long as the library does not change
+            lib_hash = FileHash(module_lib)
+            self.copy_dir = os.path.join(self.cache_dir if self.cache_dir is not None else subproc_dir, 'rwcache', lib_hash)
+            print('>> Using copies of %s in %s' % (module_lib, self.copy_dir))
             os.chdir(iwd)
-
+        elif self.mode == 1:
             os.chdir(subproc_dir)
+            if internal_mod_name in sys.modules:
+                del sys.modules[internal_mod_name]
+            spec = importlib.util.spec_from_file_location(internal_mod_name, os.path.join(subproc_dir, module_lib))
+            mod = importlib.util.module_from_spec(spec)
+            sys.modules[internal_mod_name] = mod
+            spec.loader.exec_module(mod)
+            self.full_mod = mod
+
+            if hasattr(mod, 'set_madloop_path'):
+                mod.set_madloop_path(os.path.join(subproc_dir, 'MadLoop5_resources'))
+
+            # Each common block is snapshotted as one contiguous region of memory, so that
+            # restoring a parameter point is a single bulk copy per block
+            self.cache_regions = []
+            for block in self.tocache:
+                if not hasattr(mod, block):
+                    continue
+                arrays = [val for key, val in sorted(getattr(mod, block).__dict__.items()) if isinstance(val, numpy.ndarray)]
+                self.cache_regions.extend(MemoryRegions(arrays))
+            offsets = numpy.cumsum([0] + [region.nbytes for region in self.cache_regions])
+            self.cache_slices = [slice(offsets[i], offsets[i + 1]) for i in range(len(self.cache_regions))]
+            print('>> Caching %i bytes in %i regions per reweight point' % (offsets[-1], len(self.cache_regions)))
+
+            # One contiguous buffer holding the snapshots of the initialised points, with
+            # cache_rows giving the row of each point
+            self.caches = numpy.empty((0, offsets[-1]), dtype=numpy.uint8)
+            self.cache_rows = [-1] * self.N
+            os.chdir(iwd)
+        else:
+            raise ValueError('Unknown mode %s, must be 0 or 1' % self.mode)
 
-            for i in range(int(self.N)):
+        self.InitPoints(self.active)
+
+    def InitPoints(self, points):
+        """Initialise the modules (mode 0) or parameter caches (mode 1) for the given reweight points, if not done already"""
+        points = [i for i in points if i not in self.initialised]
+        if not points:
+            return
+        iwd = os.getcwd()
+        os.chdir(self.subproc_dir)
+        if self.mode == 0:
+            ncopied = 0
+            for i in points:
+                ncopied += CachedCopy(os.path.join(self.subproc_dir, self.module_lib), os.path.join(self.copy_dir, 'rwdir_%i' % i, self.module_lib))
+            if ncopied > 0:
+                print('>> Created %i new copies' % ncopied)
+
+            for i in points:
                 # sys.path[-1] = '%s/rwdir_%i' % (subproc_dir, i)
                 # print([p for p in sys.path if subproc_dir in p])
                 # print imp.find_module('allmatrix2py')
-                if internal_mod_name in sys.modules:
-                    del sys.modules[internal_mod_name]
-                so_path = os.path.join(subproc_dir, f'rwdir_{i}', module_lib)
-                spec = importlib.util.spec_from_file_location(internal_mod_name, so_path)
+                if self.internal_mod_name in sys.modules:
+                    del sys.modules[self.internal_mod_name]
+                so_path = os.path.join(self.copy_dir, f'rwdir_{i}', self.module_lib)
+                spec = importlib.util.spec_from_file_location(self.internal_mod_name, so_path)
                 mod = importlib.util.module_from_spec(spec)
-                sys.modules[internal_mod_name] = mod
+                sys.modules[self.internal_mod_name] = mod
                 spec.loader.exec_module(mod)
-                self.mods.append(mod)
+                self.mods[i] = mod
                 # self.mods.append(imp.load_module('all_matrix2py', *imp.find_module('all_matrix2py')))
                 # del sys.modules['all_matrix2py']
-                self.mods[-1].initialise('%s/param_card_%i.dat' % (self.target_dir, i))
-                if hasattr(self.mods[-1], 'set_madloop_path'):
-                    self.mods[-1].set_madloop_path(os.path.join(subproc_dir, 'MadLoop5_resources'))
-
-            os.chdir(iwd)
+                mod.initialise('%s/param_card_%i.dat' % (self.target_dir, i))
+                if hasattr(mod, 'set_madloop_path'):
+                    mod.set_madloop_path(os.path.join(self.subproc_dir, 'MadLoop5_resources'))
         elif self.mode == 1:
-            os.chdir(subproc_dir)
-            spec = importlib.util.spec_from_file_location("allmatrix3py", os.path.join(subproc_dir, module_lib))
-            mod = importlib.util.module_from_spec(spec)
-            sys.modules[full_mod_name] = mod
-            spec.loader.exec_module(mod)
-            self.mods.append(mod)
-
-            if hasattr(mod, 'set_madloop_path'):
-                mod.set_madloop_path(os.path.join(subproc_dir, 'MadLoop5_resources'))
-            self.references = {}
-
-            for block in self.tocache:
-                print('>>> %s' % block)
-                self.references[block] = []
-                self.caches[block] = []
-                fortran_dict = getattr(mod, block).__dict__
-                for key, val in fortran_dict.items():
-                    self.references[block].append((key, val))
-                # print self.references[block]
-
-            for i in range(self.N):
+            mod = self.full_mod
+            first_row = self.caches.shape[0]
+            self.caches = numpy.concatenate((self.caches, numpy.empty((len(points), self.caches.shape[1]), dtype=numpy.uint8)))
+            for row, i in enumerate(points, start=first_row):
                 mod.initialise('%s/param_card_%i.dat' % (self.target_dir, i))
-                for block in self.tocache:
-                    cache = []
-                    for key, val in self.references[block]:
-                        cache.append(val.copy())
-                    self.caches[block].append(cache)
-
-                # for i in range(len(self.references[block])):
-                #     vals = [X[i] for X in self.caches[block]]
-                #     allequal = vals.count(vals[0]) == len(vals)
-                #     print self.references[block][i], allequal
-            # print self.caches
-            # print self.references
-            # print self.references['couplings']
-            # for key, val in mod.couplings.__dict__.iteritems():
-            #     cache.append((key, val, val.copy()))
-            os.chdir(iwd)
-            # sys.exit(0)
+                for region, cache_slice in zip(self.cache_regions, self.cache_slices):
+                    self.caches[row, cache_slice] = region
+                self.cache_rows[i] = row
+        self.initialised.update(points)
+        os.chdir(iwd)
+
+    def SelectPoints(self, pars=None, terms=None):
+        """
+        Choose the subset of reweight points to initialise and evaluate. The weights keep the
+        full layout of N = 1 + 2P + P(P-1)/2 points, in the order of the reweight_card.dat:
+
+            0                    SM
+            2*i + 1, 2*i + 2     parameter i set to half of, and to, its value in the config
+            1 + 2*P + k          the k-th pair of parameters (i, j), i < j, both set to their values
+
+        pars is a list of parameter names to consider (default: all), and terms a list of the
+        term types to extract, any of 'linear', 'square' and 'cross' (default: all). The linear
+        and square terms of a parameter both need its two points, so selecting either gives
+        both. The cross term of a pair needs the pair point and the full-value points of the
+        two parameters (2*i + 2 and 2*j + 2). Points that are not needed are not initialised,
+        and their weights are NaN in the output of ComputeWeights and ComputeWeightsBatch. This
+        propagates through TransformWeights, so the terms that depend on them are also NaN.
+        Points that are newly selected are initialised straight away.
+        Returns the sorted list of selected points, also stored in self.active.
+        """
+        self.active = ActivePoints(self.pars, pars, terms)
+        self.default_weights = [1.0 if iw in self.active else float('nan') for iw in range(self.N)]
+        if hasattr(self, 'initialised'):
+            self.InitPoints(self.active)
+        return self.active
 
     def RestoreCache(self, index):
-        for block in self.tocache:
-            restore_to = self.references[block]
-            restore_from = self.caches[block][index]
-            for i in range(len(restore_to)):
-                numpy.copyto(restore_to[i][1], restore_from[i])
+        """Restore the common blocks of the single module (mode 1) to reweight point index"""
+        snapshot = self.caches[self.cache_rows[index]]
+        for region, cache_slice in zip(self.cache_regions, self.cache_slices):
+            numpy.copyto(region, snapshot[cache_slice])
+
+    def ReadMasses(self):
+        """Read the particle masses {pdg: mass} from the MASS block of the SM param card"""
+        masses = {}
+        in_block = False
+        with open(os.path.join(self.target_dir, 'param_card_0.dat')) as card:
+            for line in card:
+                words = line.split('#')[0].split()
+                if not words:
+                    continue
+                if words[0].lower() in ['block', 'decay']:
+                    in_block = len(words) > 1 and words[0].lower() == 'block' and words[1].lower() == 'mass'
+                elif in_block and len(words) >= 2:
+                    masses[int(words[0])] = abs(float(words[1]))
+        return masses
+
+    def RandomEvents(self, idx, nevents, rng, ecm=None):
+        """
+        Generate random phase-space points for subprocess idx, in the particle order of
+        self.all_pdgs[idx]. Returns (parts, pdgs, hels, stats) arrays in the format of
+        ComputeWeightsBatch, with all helicities set to zero. Intended for benchmarks and
+        numerical tests of the matrix elements.
+        """
+        masses = self.ReadMasses()
+        pdgs = self.all_pdgs[idx]
+        fnal_masses = [masses.get(abs(pdg), 0.) for pdg in pdgs[self.nInits:]]
+        if self.nInits == 1:
+            ecm = masses.get(abs(pdgs[0]), 0.)
+        elif len(fnal_masses) == 1:
+            ecm = fnal_masses[0]
+        elif ecm is None:
+            ecm = max(2. * sum(fnal_masses), 500.)
+        parts = numpy.zeros((nevents, len(pdgs), 4))
+        parts[:, self.nInits:] = lorentz_kernels.Rambo(ecm, fnal_masses, nevents, rng)
+        if self.nInits == 1:
+            parts[:, 0, 0] = ecm
+        else:
+            parts[:, 0] = [ecm / 2., 0., 0., ecm / 2.]
+            parts[:, 1] = [ecm / 2., 0., 0., -ecm / 2.]
+        stats = numpy.ones((nevents, len(pdgs)), dtype=numpy.int64)
+        stats[:, :self.nInits] = -1
+        return (parts, numpy.tile(pdgs, (nevents, 1)), numpy.zeros((nevents, len(pdgs)), dtype=numpy.int64), stats)
 
+    def ProbeSMPoints(self, nevents=5, seed=1, tolerance=1e-12):
+        """
+        Find the reweight points that do not change the matrix element of each subprocess,
+        e.g. gluon operators for qq->ZH. Each selected point is evaluated at nevents random
+        phase-space points (see RandomEvents) and if the ratio to the SM differs from one by
+        no more than tolerance for all of them, the point is added to self.sm_points[idx].
+        The matrix element is then not evaluated for these points at runtime, and their
+        weight is set to 1.0. The same seed is used in every instance, so parallel jobs skip
+        the same points.
+        """
+        if self.session is None:
+            with self.Session():
+                return self.ProbeSMPoints(nevents, seed, tolerance)
+        rng = numpy.random.default_rng(seed)
+        for idx in range(len(self.all_pdgs)):
+            parts, pdgs, hels, stats = self.RandomEvents(idx, nevents, rng)
+            ratios = numpy.ones((nevents, self.N))
+            for ie in range(nevents):
+                final_parts_i = parts[ie].T
+                val_ref = 1.0
+                for iw in self.active:
+                    val = self.EvalME(iw, self.all_pdgs[idx], final_parts_i, 0.118, 0., -1)
+                    if iw == 0:
+                        val_ref = val
+                    with numpy.errstate(divide='ignore', invalid='ignore'):
+                        ratios[ie, iw] = numpy.float64(val) / val_ref
+            self.sm_points[idx] = set(iw for iw in self.active if iw != 0 and numpy.all(numpy.abs(ratios[:, iw] - 1.) <= tolerance))
+            print('>> Subprocess %s: %i of %i selected points do not change the matrix element and will be skipped' % (
+                self.all_prefix[idx], len(self.sm_points[idx]), len(self.active)))
+        return self.sm_points
+
+    def EvalPoints(self, idx):
+        """The selected reweight points for which the matrix element of subprocess idx must be evaluated"""
+        sm_points = self.sm_points.get(idx)
+        if not sm_points:
+            return self.active
+        return [iw for iw in self.active if iw not in sm_points]
 
     def SortPDGs(self, pdgs):
         return sorted(pdgs[:self.nInits]) + sorted(pdgs[self.nInits:])
@@ -349,17 +776,30 @@ class StandaloneReweight(object):
 
         return p
 
-    def ComputeWeights(self, parts, pdgs, hels, stats, alphas, dohelicity=True, verb=False):
-        assert len(parts) == len(pdgs) == len(hels) == len(stats)
-        if self.no_match_behaviour=='return False':
-            res = False
-        else:
-            res = [1.0] * self.N
-
+    def MatchLayout(self, pdgs, stats, verb=False):
+        """
+        Find the subprocess matching the (status, pdg) layout of an event. Returns a tuple
+        (idx, reorder_pids, hel_dict), where idx is the index of the subprocess, reorder_pids
+        the positions of the event particles in the order expected by the matrix element and
+        hel_dict the helicity dict of the subprocess, or None if the layout does not match
+        any known process. The result is cached, so each distinct layout is only matched once.
+        """
+        key = tuple(zip(stats, pdgs))
+        try:
+            match = self.layout_cache[key]
+        except KeyError:
+            match = self.layout_cache[key] = self.BuildLayout(pdgs, stats)
+        if verb and match is not None:
+            print('>> Event layout is %s, matching target layout %s => ordering is %s' % (
+                [pdgs[ip] for ip in range(len(pdgs)) if stats[ip] in [-1, 1]], self.all_pdgs[match[0]], match[1]))
+        return match
+
+    def BuildLayout(self, pdgs, stats):
+        """Match an event layout to a subprocess, see MatchLayout"""
         init_pdg_dict = defaultdict(list)
         fnal_pdg_dict = defaultdict(list)
 
-        nParts = len(parts)
+        nParts = len(pdgs)
         nInits = 0 #count number of incoming particles
         selected_pdgs = []
         for ip in range(nParts):
@@ -374,13 +814,9 @@ class StandaloneReweight(object):
 
         assert nInits==self.nInits #check that nInits guess from earlier was correct
 
-        evt_sorted_pdgs = self.SortPDGs(selected_pdgs)
-
-        try:
-            idx = self.sorted_pdgs.index(evt_sorted_pdgs)
-        except ValueError:
-            print('>> Event with PDGs %s does not match any known process' % pdgs)
-            return res
+        idx = self.sorted_pdg_index.get(tuple(self.SortPDGs(selected_pdgs)))
+        if idx is None:
+            return None
 
         target_pdgs = self.all_pdgs[idx]
 
@@ -391,227 +827,514 @@ class StandaloneReweight(object):
                 reorder_pids.append(init_pdg_dict[target].pop(0))
             else:
                 reorder_pids.append(fnal_pdg_dict[target].pop(0))
-        if verb:
-            print('>> Event layout is %s, matching target layout %s => ordering is %s' % (selected_pdgs, target_pdgs, reorder_pids))
+        return idx, reorder_pids, self.hel_dict.get(self.all_prefix[idx], {})
 
-        final_pdgs = []
-        final_parts = []
-        final_hels = []
-        for ip in reorder_pids:
-            final_parts.append(parts[ip])
-            final_pdgs.append(pdgs[ip])
-            final_hels.append(hels[ip])
-        # print final_pdgs
+    def GetHelicityTable(self, idx):
+        """The encoded helicity table (see HelicityTable) of subprocess idx"""
+        prefix = self.all_prefix[idx]
+        if prefix not in self.hel_tables:
+            self.hel_tables[prefix] = HelicityTable(self.hel_dict.get(prefix, {}))
+        return self.hel_tables[prefix]
 
-        com_final_parts = []
-        if nInits == 1:
+    def BoostToCOM(self, final_parts):
+        """
+        Boost the (reordered) particles into the partonic centre-of-mass frame. final_parts
+        is either a single event (nparticles, 4) or a batch of events (nevents, nparticles, 4).
+        Batches use the vectorised lorentz_kernels, for a single event the scalar boosts are faster.
+        """
+        if numpy.ndim(final_parts) == 3:
+            return lorentz_kernels.BoostToCOM(numpy.asarray(final_parts, dtype=numpy.float64), self.nInits)
+        final_parts = numpy.asarray(final_parts, dtype=numpy.float64).tolist()
+        if self.nInits == 1:
             pboost = [final_parts[0][i] for i in range(4)]
-        elif nInits == 2:
+        elif self.nInits == 2:
             pboost = [final_parts[0][i] + final_parts[1][i] for i in range(4)]
         else:
             raise Exception("More than two initial particles.")
 
+        com_final_parts = []
         for part in final_parts:
             if (pboost[1]!=0) or (pboost[2]!=0): #if non-zero pt boost do boost in all directions
                 com_final_parts.append(self.allboost(part, pboost))
             else: #otherwise just boost along z
                 com_final_parts.append(self.zboost(part, pboost))
-            
+        return numpy.array(com_final_parts, dtype=numpy.float64)
+
+    def Session(self, log=None, max_lines=100, interval=60.):
+        """
+        Start a ReweightSession, which suppresses the Fortran output of all matrix element calls
+        until it ends, e.g.
+
+            with rw.Session():
+                for event in events:
+                    rw.ComputeWeights(...)
+
+        Without an open session each call to ComputeWeights or ComputeWeightsBatch opens one.
+        """
+        return ReweightSession(self, log, max_lines, interval)
+
+    def EvalME(self, iw, final_pdgs, final_parts_i, alphas, scale2, nhel):
+        """Evaluate the matrix element for reweight point iw"""
+        # The MadLoop output is suppressed by the ReweightSession of the calling function
+        if self.mode == 0:
+            #smatrixhel(pdgs,procid,p,alphas,scale2,nhel,npdg=len(pdgs))
+            # print(final_pdgs, final_parts_i, alphas, scale2, nhel)
+            val = self.mods[iw].smatrixhel(final_pdgs, -1, final_parts_i, alphas, scale2, nhel)
+        elif self.mode == 1:
+            self.RestoreCache(iw)
+            val = self.full_mod.smatrixhel(final_pdgs, -1, final_parts_i, alphas, scale2, nhel)
+        if self.nlo:
+            val = val[0]
+        return val
+
+    def ComputeWeights(self, parts, pdgs, hels, stats, alphas, dohelicity=True, verb=False):
+        if self.session is None:
+            with self.Session():
+                return self.ComputeWeights(parts, pdgs, hels, stats, alphas, dohelicity, verb)
+        assert len(parts) == len(pdgs) == len(hels) == len(stats)
+        if self.no_match_behaviour=='return False':
+            res = False
+        else:
+            res = list(self.default_weights)
+
+        monitor = self.monitor
+        if monitor.timing:
+            t0 = time.perf_counter()
+        match = self.MatchLayout(pdgs, stats, verb)
+        if monitor.timing:
+            monitor.AddTime('match', None, None, time.perf_counter() - t0)
+        if match is None:
+            key = str([int(pdg) for pdg in pdgs])
+            if monitor.Count('unmatched', key):
+                print('>> Event with PDGs %s does not match any known process (further events are only counted)' % key)
+            return res
+        idx, reorder_pids, hel_dict = match
+        prefix = self.all_prefix[idx]
+        monitor.Count('events', prefix)
+
+        final_pdgs = []
+        final_parts = []
+        final_hels = []
+        for ip in reorder_pids:
+            final_parts.append(parts[ip])
+            final_pdgs.append(pdgs[ip])
+            final_hels.append(hels[ip])
+        # print final_pdgs
 
-        final_parts_i = self.invert_momenta(com_final_parts)
+        if monitor.timing:
+            t0 = time.perf_counter()
+        final_parts_i = self.BoostToCOM(final_parts).T
+        if monitor.timing:
+            monitor.AddTime('boost', prefix, None, time.perf_counter() - t0)
 
         nhel = -1  # means sum over all helicity
 
         if dohelicity:
-            hel_dict = self.hel_dict[self.all_prefix[idx]]
             t_final_hels = tuple(final_hels)
             if t_final_hels in hel_dict:
                 nhel = hel_dict[t_final_hels]
                 if verb:
                     print('>> Selected nhel=%i, from dict %s' % (nhel, self.all_prefix[idx]))
-            else:
-                print('>> Helicity configuration %s was not found in dict, using -1' % final_hels)
+            elif monitor.Count('helicity_not_found', prefix):
+                print('>> Helicity configuration %s was not found in dict, using -1 (further cases are only counted)' % [int(h) for h in final_hels])
         scale2 = 0.
         val_ref = 1.0
-        for iw in range(self.N):
-            if self.mode == 0:
-                with stdchannel_redirected(sys.stdout, os.devnull): #prevent MadLoop output
-                  #smatrixhel(pdgs,procid,p,alphas,scale2,nhel,npdg=len(pdgs))
-                    # print(final_pdgs, final_parts_i, alphas, scale2, nhel)
-                    val = self.mods[iw].smatrixhel(final_pdgs, -1, final_parts_i, alphas, scale2, nhel)
-            elif self.mode == 1:
-                self.RestoreCache(iw)
-                val = self.mods[0].smatrixhel(final_pdgs, -1, final_parts_i, alphas, scale2, nhel)
-            if self.nlo:
-                val = val[0]
+        res = list(self.default_weights)
+        for iw in self.EvalPoints(idx):
+            if monitor.timing:
+                t0 = time.perf_counter()
+            val = self.EvalME(iw, final_pdgs, final_parts_i, alphas, scale2, nhel)
+            if monitor.timing:
+                monitor.AddTime('me', prefix, iw, time.perf_counter() - t0)
             if iw == 0:
                 val_ref = val
             res[iw] = val / val_ref
         return res
 
-    def TransformWeights(self, raw_weights):
-        N = len(raw_weights)
-        verb = 0
-        if verb > 0:
-            print("-- Have %i weights" % N)
-        out = [0.] * len(raw_weights)
-        out_unscaled = [0.] * len(raw_weights)
-        Npars = self.Npars
-        for i in range(N):
-            if verb > 0:
-                print(" - %f" % raw_weights[i])
-            out[i] = raw_weights[i]
-            out_unscaled[i] = raw_weights[i]
+    def ComputeWeightsBatch(self, parts, pdgs, hels, stats, alphas, dohelicity=True, verb=False):
+        """
+        Compute the weights for a batch of events in one call.
+
+        parts: array (nevents, nparticles, 4) of momenta in [E, px, py, pz] format
+        pdgs, hels, stats: arrays (nevents, nparticles)
+        alphas: array (nevents) or a single value used for all events
+
+        Events with fewer particles than nparticles can be padded with entries of status 0,
+        these are ignored in the same way as intermediate particles. The PDG matching and
+        reordering is done once for each distinct (status, pdg) layout in the batch.
+
+        Returns an array (nevents, N) of weights. Rows for events that do not match any known
+        process are filled with 1.0, or with NaN if no_match_behaviour = 'return False'.
+        Points that are not selected (see SelectPoints) are always NaN.
+        """
+        if self.session is None:
+            with self.Session():
+                return self.ComputeWeightsBatch(parts, pdgs, hels, stats, alphas, dohelicity, verb)
+        parts = numpy.asarray(parts, dtype=numpy.float64)
+        pdgs = numpy.asarray(pdgs, dtype=numpy.int64)
+        hels = numpy.asarray(hels)
+        stats = numpy.asarray(stats, dtype=numpy.int64)
+        nEvents = parts.shape[0]
+        alphas = numpy.broadcast_to(numpy.asarray(alphas, dtype=numpy.float64), (nEvents,))
+        assert parts.shape[:2] == pdgs.shape == hels.shape == stats.shape and parts.shape[2] == 4
+
+        if self.no_match_behaviour=='return False':
+            res = numpy.full((nEvents, self.N), numpy.nan)
+        else:
+            res = numpy.tile(self.default_weights, (nEvents, 1))
+        if nEvents == 0:
+            return res
+
+        layouts, layout_idx = numpy.unique(numpy.concatenate((stats, pdgs), axis=1), axis=0, return_inverse=True)
+        layout_idx = layout_idx.reshape(-1)
+        monitor = self.monitor
+        nParts = parts.shape[1]
+        scale2 = 0.
+        for il in range(len(layouts)):
+            evt_stats = layouts[il][:nParts].tolist()
+            evt_pdgs = layouts[il][nParts:].tolist()
+            events = numpy.nonzero(layout_idx == il)[0]
+            if monitor.timing:
+                t0 = time.perf_counter()
+            match = self.MatchLayout(evt_pdgs, evt_stats, verb)
+            if monitor.timing:
+                monitor.AddTime('match', None, None, time.perf_counter() - t0, len(events))
+            if match is None:
+                key = str([pdg for pdg, st in zip(evt_pdgs, evt_stats) if st != 0])
+                if monitor.Count('unmatched', key, len(events)):
+                    print('>> %i events with PDGs %s do not match any known process (further events are only counted)' % (len(events), key))
+                continue
+            idx, reorder_pids, hel_dict = match
+            prefix = self.all_prefix[idx]
+            monitor.Count('events', prefix, len(events))
+            final_pdgs = [evt_pdgs[ip] for ip in reorder_pids]
+            if monitor.timing:
+                t0 = time.perf_counter()
+            com_final_parts = self.BoostToCOM(parts[events][:, reorder_pids])
+            if monitor.timing:
+                monitor.AddTime('boost', prefix, None, time.perf_counter() - t0, len(events))
+            final_hels = hels[events][:, reorder_pids]
+            # Points that are not evaluated keep the SM weight of 1.0
+            res[events] = self.default_weights
+            eval_points = self.EvalPoints(idx)
+
+            nhels = numpy.full(len(events), -1, dtype=numpy.int64)  # -1 means sum over all helicity
+            if dohelicity:
+                nhels = LookupHelicities(self.GetHelicityTable(idx), final_hels)
+                not_found = numpy.nonzero(nhels == -1)[0]
+                if len(not_found) and monitor.Count('helicity_not_found', prefix, len(not_found)):
+                    print('>> Helicity configuration %s was not found in dict, using -1 (further cases are only counted)' % [int(round(h)) for h in final_hels[not_found[0]]])
+
+            for ie, iev in enumerate(events):
+                final_parts_i = com_final_parts[ie].T
+                nhel = int(nhels[ie])
+                val_ref = 1.0
+                for iw in eval_points:
+                    if monitor.timing:
+                        t0 = time.perf_counter()
+                    val = self.EvalME(iw, final_pdgs, final_parts_i, alphas[iev], scale2, nhel)
+                    if monitor.timing:
+                        monitor.AddTime('me', prefix, iw, time.perf_counter() - t0)
+                    if iw == 0:
+                        val_ref = val
+                    res[iev, iw] = val / val_ref
+        return res
 
+    def BuildTransformMatrix(self):
+        """
+        Build the N x N matrix that transforms the raw weights into the coefficients of the
+        weight as a function of the parameters. Writing s0 for the SM weight, s1 and s2 for the
+        weights with parameter i at half and the full value v_i, and s12 for the weight with
+        parameters i and j at their values (s2' being the s2 of parameter j):
+
+            linear term i    A_i  = (4 s1 - s2 - 3 s0) / v_i
+            square term i    B_ii = (2 s2 - 4 s1 + 2 s0) / v_i^2
+            cross term i,j   B_ij = (s12 - s2 - s2' + s0) / (v_i v_j)
+        """
+        N = self.N
+        Npars = self.Npars
+        M = numpy.zeros((N, N))
+        M[0, 0] = 1.
         for ip in range(Npars):
-            s0 = raw_weights[0]
-            s1 = raw_weights[ip * 2 + 1]
-            s2 = raw_weights[ip * 2 + 2]
-            if verb > 0:
-                print(" -- Doing %i" % ip)
-                print("%f\t%f\t%f" % (s0, s1, s2))
-            s1 -= s0
-            s2 -= s0
-            if verb > 0:
-                print(" - subtract s0: %f\t%f" % (s1, s2))
-            Ai = 4. * s1 - s2
-            Bii = s2 - Ai
-            if verb > 0:
-                print(" - Result: %f\t%f" % (Ai, Bii))
-            out[ip * 2 + 1] = Ai
-            out[ip * 2 + 2] = Bii
-            out_unscaled[ip * 2 + 1] = (Ai / self.parVals[ip])
-            out_unscaled[ip * 2 + 2] = (Bii / (self.parVals[ip] * self.parVals[ip]))
+            v = self.parVals[ip]
+            M[ip * 2 + 1, [0, ip * 2 + 1, ip * 2 + 2]] = numpy.array([-3., 4., -1.]) / v
+            M[ip * 2 + 2, [0, ip * 2 + 1, ip * 2 + 2]] = numpy.array([2., -4., 2.]) / (v * v)
         crossed_offset = 1 + 2 * Npars
         c_counter = 0
         for ix in range(0, Npars):
             for iy in range(ix + 1, Npars):
-                if verb > 0:
-                    print(" -- Doing %i\t%i\t[%i]" % (ix, iy, crossed_offset + c_counter))
-                s = raw_weights[crossed_offset + c_counter]
-                sm = raw_weights[0]
-                sx = out[ix * 2 + 1]
-                sy = out[iy * 2 + 1]
-                sxx = out[ix * 2 + 2]
-                syy = out[iy * 2 + 2]
-                s -= (sm + sx + sy + sxx + syy)
-                out[crossed_offset + c_counter] = s
-                out_unscaled[crossed_offset + c_counter] = s / (self.parVals[ix] * self.parVals[iy])
-                if verb > 0:
-                    print(" - Result: %f" % s)
+                ic = crossed_offset + c_counter
+                M[ic, [0, ix * 2 + 2, iy * 2 + 2, ic]] = numpy.array([1., -1., -1., 1.]) / (self.parVals[ix] * self.parVals[iy])
                 c_counter += 1
+        return M
 
-        return out_unscaled
+    def TransformWeights(self, raw_weights):
+        """
+        Transform raw weights, relative to the SM, into the coefficients of the linear, square
+        and cross terms, in the same layout. raw_weights is either the list for one event from
+        ComputeWeights, in which case a list is returned, or an array (nevents, N), e.g. from
+        ComputeWeightsBatch, in which case an array (nevents, N) is returned.
+        """
+        raw = numpy.asarray(raw_weights, dtype=numpy.float64)
+        assert raw.shape[-1] == self.N
+        out = MaskedDot(raw, self.transform_matrix)
+        if isinstance(raw_weights, list):
+            return out.tolist()
+        return out
 
     def CalculateWeight(self, transformed_weights, **kwargs):
-        # print kwargs
-        wt = transformed_weights[0]
+        """
+        Calculate the weight for given parameter values from the transformed weights, e.g.
+
+            rw.CalculateWeight(transformed_weights, cW=0.1, cHW=0.1)
+
+        Parameters that are not given are set to zero. The values can also be arrays of the
+        same length npoints, to evaluate many parameter points at once. transformed_weights
+        can be for one event (N) or for many events (nevents, N). The result has shape
+        (npoints), (nevents, npoints) or (nevents), or is a float, following the inputs.
+        """
+        vals = dict([(par, numpy.atleast_1d(numpy.asarray(val, dtype=numpy.float64))) for par, val in kwargs.items() if par in self.pars])
+        npoints = max([len(val) for val in vals.values()] + [1])
+        coeffs = numpy.zeros((npoints, self.N))
+        coeffs[:, 0] = 1.
         for i in range(self.Npars):
             par = self.pars[i]
-            if par in kwargs:
-                # print transformed_weights[i * 2 + 1], transformed_weights[i * 2 + 2]
-                wt += transformed_weights[i * 2 + 1] * kwargs[par]
-                wt += transformed_weights[i * 2 + 2] * kwargs[par] * kwargs[par]
+            if par in vals:
+                coeffs[:, i * 2 + 1] = vals[par]
+                coeffs[:, i * 2 + 2] = vals[par] * vals[par]
         crossed_offset = 1 + 2 * self.Npars
         c_counter = 0
         for ix in range(0, self.Npars):
             for iy in range(ix + 1, self.Npars):
-                if self.pars[ix] in kwargs and self.pars[iy] in kwargs:
-                    # print transformed_weights[crossed_offset + c_counter] 
-                    wt += transformed_weights[crossed_offset + c_counter] * kwargs[self.pars[ix]] * kwargs[self.pars[iy]]
+                if self.pars[ix] in vals and self.pars[iy] in vals:
+                    coeffs[:, crossed_offset + c_counter] = vals[self.pars[ix]] * vals[self.pars[iy]]
                 c_counter += 1
+        wt = MaskedDot(numpy.asarray(transformed_weights, dtype=numpy.float64), coeffs)
+        if all(numpy.ndim(val) == 0 for val in kwargs.values()):
+            wt = wt[..., 0]
+        if wt.ndim == 0:
+            return float(wt)
         return wt
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--module', default='.')
-    # parser.add_argument('--cards', default='rw_config')
-    # parser.add_argument('--config', default='test.json')
-    parser.add_argument('--helicity', type=int, default=1)
-    parser.add_argument('-i', '--input', default='input.lhe')
-    parser.add_argument('-o', '--output', default='output.lhe')
-    parser.add_argument('--validate', action='store_true')
-    args = parser.parse_args()
-
-    iwd = os.getcwd()
+def StackEvents(events):
+    """
+    Stack a list of events from LHEEvent.Info into the arrays used by ComputeWeightsBatch.
+    Events with fewer particles are padded with entries of status 0.
+    """
+    nParts = max(len(pdgs) for parts, pdgs, hels, stats, alphas in events)
+    parts = numpy.zeros((len(events), nParts, 4))
+    pdgs = numpy.zeros((len(events), nParts), dtype=numpy.int64)
+    hels = numpy.zeros((len(events), nParts), dtype=numpy.int64)
+    stats = numpy.zeros((len(events), nParts), dtype=numpy.int64)
+    alphas = numpy.zeros(len(events))
+    for ie, (evt_parts, evt_pdgs, evt_hels, evt_stats, evt_alphas) in enumerate(events):
+        n = len(evt_pdgs)
+        parts[ie, :n] = evt_parts
+        pdgs[ie, :n] = evt_pdgs
+        hels[ie, :n] = evt_hels
+        stats[ie, :n] = evt_stats
+        alphas[ie] = evt_alphas
+    return parts, pdgs, hels, stats, alphas
+
+
+def ReweightEvents(rw, events, dohelicity, transform=False):
+    """
+    Compute the weights, and optionally the transformed weights, for a list of events from
+    LHEEvent.Info in one ComputeWeightsBatch call. Returns arrays (nevents, N), the second
+    one is None if transform is False.
+    """
+    if len(events) == 0:
+        res = numpy.zeros((0, rw.N))
+    else:
+        res = rw.ComputeWeightsBatch(*StackEvents(events), dohelicity=dohelicity)
+    return res, rw.TransformWeights(res) if transform else None
 
 
-    ROOT.gROOT.ProcessLine('#include "LHEF.h"')
+# Each worker process of the --workers mode owns one StandaloneReweight instance
+worker_rw = None
+# The error if it could not be created. An exception in the Pool initializer would make the
+# pool restart the worker forever, so it is raised from ReweightChunk instead.
+worker_error = None
 
-    # // Create Reader and Writer object
-    reader = ROOT.LHEF.Reader(args.input)
-    writer = ROOT.LHEF.Writer(args.output)
-    rw = StandaloneReweight(args.module)
-    # # // Copy header and init blocks and write them out.
-    # //  if ( reader.outsideBlock.length() ) std::cerr << reader.outsideBlock;
-    # print reader.headerBlock
 
-    writer.headerBlock().write(str(reader.headerBlock), len(str(reader.headerBlock)))
-    writer.initComments().write(str(reader.initComments), len(str(reader.initComments)))
-    writer.heprup = reader.heprup
-    writer.heprup.weightgroup.clear()
-    writer.heprup.weightinfo.clear()
+def InitWorker(rw_pack, mode, cache_dir, pars, terms, me_log, timing, skip_sm_points):
+    global worker_rw, worker_error
+    try:
+        worker_rw = StandaloneReweight(rw_pack, mode=mode, cache_dir=cache_dir, pars=pars, terms=terms, timing=timing, skip_sm_points=skip_sm_points)
+    except Exception:
+        worker_error = traceback.format_exc()
+        return
+    # The Fortran output stays redirected for the lifetime of the worker
+    worker_rw.Session(log=None if me_log is None else '%s.%i' % (me_log, os.getpid())).__enter__()
 
-    weightgroup = ROOT.LHEF.WeightGroup()
-    # weightgroup.attributes['name'] ="mg_reweighting"
-    # weightgroup.attributes['weight_name_strategy'] = "includeIdInWeightName"
-    writer.heprup.weightgroup.push_back(weightgroup)
 
-    for iw in range(rw.N):
-        weightinfo = ROOT.LHEF.WeightInfo()
-        weightinfo.name = 'rw%.4i' % iw
-        weightinfo.inGroup = 0
-        weightinfo.isrwgt = True
-        weightinfo.contents = 'from param_card_%i.dat' % iw
-        writer.heprup.weightinfo.push_back(weightinfo)
+def ReweightChunk(chunk):
+    """Reweight a chunk of events in a worker, returns the results and the counters and timing for this chunk"""
+    if worker_error is not None:
+        raise RuntimeError('Worker process %i could not load the reweighting module:\n%s' % (os.getpid(), worker_error))
+    worker_rw.monitor.Reset()
+    return ReweightEvents(worker_rw, *chunk), worker_rw.monitor
 
 
-    writer.init()
-    neve = 0
-    # // Read each event and write them out again.
-    while reader.readEvent():
-        ++neve
-        # if reader.outsideBlock.length() ) std::cout << reader.outsideBlock;
-        writer.eventComments().write(str(reader.eventComments), len(str(reader.eventComments)))
-        writer.hepeup = reader.hepeup
-        existing = []
-        if args.validate:
-            print('>> Reading %i existing weights' % (writer.hepeup.weights.size() - 1))
-            # The first weight is the original weight - we should skip it
-            for iorig in range(1, writer.hepeup.weights.size()):
-                existing.append(writer.hepeup.weights[iorig].first)
-        writer.hepeup.namedweights.clear()
-        writer.hepeup.weights.clear()
-
-        parts = []
-        pdgs = []
-        hels = []
-        stats = []
-        nParts = writer.hepeup.NUP
-        for ip in range(nParts):
-            # Put in EPxPyPz format
-            parts.append([writer.hepeup.PUP[ip][3], writer.hepeup.PUP[ip][0], writer.hepeup.PUP[ip][1], writer.hepeup.PUP[ip][2]])
-            pdgs.append(int(writer.hepeup.IDUP[ip]))
-            stats.append(int(writer.hepeup.ISTUP[ip]))
-            hels.append(round(writer.hepeup.SPINUP[ip]))
-        # print hels
+def WriteCheckpoint(filename, state):
+    """Write the checkpoint json file, replacing any previous version atomically"""
+    tmp = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as outfile:
+        json.dump(state, outfile, indent=2)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp, filename)
 
-        res = rw.ComputeWeights(parts, pdgs, hels, stats, writer.hepeup.AQCDUP, bool(args.helicity))
 
-        trans_res = rw.TransformWeights(res)
+def RemoveStaleCheckpoints(filename):
+    """Remove temporary checkpoint files left behind by a job that was killed while writing one"""
+    for tmp in glob(escape(filename) + '.*.tmp'):
+        if tmp[len(filename) + 1:-len('.tmp')].isdigit():
+            os.remove(tmp)
 
-        # print rw.CalculateWeight(trans_res, ca=0.01, c3w=0.01)
 
-        if args.validate:
-            for iw in range(min(len(existing), len(res))):
-                print('%-10f %-10f %-10f | %-10f' % (existing[iw] / existing[0], res[iw], res[iw] / (existing[iw] / existing[0]), trans_res[iw]))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='.')
+    # parser.add_argument('--cards', default='rw_config')
+    # parser.add_argument('--config', default='test.json')
+    parser.add_argument('--helicity', type=int, default=1)
+    parser.add_argument('-i', '--input', default='input.lhe')
+    parser.add_argument('-o', '--output', default='output.lhe')
+    parser.add_argument('--format', default='lhe', choices=['lhe', 'npz'], help="lhe: write a new LHE file with the weights added to each event, npz: only write the weights to a compressed numpy file (see join_weights.py)")
+    parser.add_argument('--validate', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes to reweight events in parallel")
+    parser.add_argument('--chunk-size', type=int, default=100, help="Number of events sent to a worker process at a time")
+    parser.add_argument('--mode', type=int, default=0, choices=[0, 1], help="0: one library copy per reweight point, 1: one library with the parameters restored from a cache for each point")
+    parser.add_argument('--cache-dir', default=None, help="Directory for the mode 0 library copies, default is inside the rw pack")
+    parser.add_argument('--pars', default=None, help="Comma separated list of parameters to reweight, default is all in the config")
+    parser.add_argument('--terms', default=None, help="Comma separated list of the terms to compute: linear,square,cross (default all)")
+    parser.add_argument('--me-log', default=None, help="Write the (rate-limited) Fortran output of the matrix elements to this file instead of discarding it")
+    parser.add_argument('--skip-sm-points', action='store_true', help="Probe each subprocess at startup and skip the matrix element calls for points that do not change it")
+    parser.add_argument('--timing-json', default=None, help="Record the time spent matching, boosting and in each matrix element call, and write a summary to this json file")
+    parser.add_argument('--checkpoint', default=None, help="Checkpoint file, default is the output file name with .checkpoint appended")
+    parser.add_argument('--checkpoint-interval', type=float, default=300., help="Minimum time in seconds between checkpoints, 0 to disable them")
+    parser.add_argument('--resume', action='store_true', help="Continue from the checkpoint file if it exists, otherwise start from the first event")
+    args = parser.parse_args()
+    sel_pars = args.pars.split(',') if args.pars is not None else None
+    sel_terms = args.terms.split(',') if args.terms is not None else None
 
-        for iw, wt in enumerate(res):
-            weight = ROOT.LHEF.Weight()
-            weight.name = 'rw%.4i' % iw
-            weight.iswgt = True
-            weight.weights.push_back(wt * writer.hepeup.XWGTUP)
-            writer.hepeup.namedweights.push_back(weight)
+    iwd = os.getcwd()
 
-        writer.hepeup.heprup = writer.heprup
-        writer.writeEvent()
+    checkpoint_file = args.checkpoint if args.checkpoint is not None else args.output + '.checkpoint'
+    if args.format == 'lhe' and args.output.endswith('.gz') and (args.resume or args.checkpoint_interval > 0):
+        print('>> Checkpoints are only supported for uncompressed output, they will not be written')
+        args.checkpoint_interval = 0
+        args.resume = False
+
+    # Reading and writing are done in background threads, overlapping with the reweighting
+    reader = lhe_stream.LHEReader(args.input)
+    if args.workers > 1:
+        # The matrix element modules are only loaded in the worker processes
+        import multiprocessing
+        rw = None
+        monitor = ReweightMonitor(args.timing_json is not None)
+        active = ActivePoints([X['name'] for X in GetConfigFile(os.path.join(args.module, 'config.json'))['parameters']], sel_pars, sel_terms)
+        pool = multiprocessing.Pool(args.workers, initializer=InitWorker, initargs=(args.module, args.mode, args.cache_dir, sel_pars, sel_terms, args.me_log, args.timing_json is not None, args.skip_sm_points))
+        # Fail before any output is written if the workers cannot load the module
+        pool.apply(ReweightChunk, (([], bool(args.helicity), False),))
+        # Read enough events per iteration to give each worker several chunks
+        window = args.workers * args.chunk_size * 4
+    else:
+        rw = StandaloneReweight(args.module, mode=args.mode, cache_dir=args.cache_dir, pars=sel_pars, terms=sel_terms, timing=args.timing_json is not None, skip_sm_points=args.skip_sm_points)
+        active = rw.active
+        monitor = rw.monitor
+        pool = None
+        window = args.chunk_size
+        # Suppress the Fortran output once for the whole run
+        session = rw.Session(log=args.me_log)
+        session.__enter__()
+
+    # Only the selected points are written, keeping their index in the weight name
+    wt_names = ['rw%.4i' % iw for iw in active]
+    neve = 0
+    if args.resume:
+        RemoveStaleCheckpoints(checkpoint_file)
+    if args.resume and os.path.isfile(checkpoint_file):
+        # The output up to the checkpoint is kept, anything written after it is discarded
+        with open(checkpoint_file) as jsonfile:
+            state = json.load(jsonfile)
+        if state['input'] != os.path.abspath(args.input) or state['weights'] != wt_names:
+            raise RuntimeError('Checkpoint %s was made with a different input file or set of weights' % checkpoint_file)
+        reader.Seek(state['input_offset'])
+        resume_offset = state['output_offset']
+        neve = state['events']
+        print('>> Resuming from checkpoint %s after %i events' % (checkpoint_file, neve))
+    else:
+        resume_offset = None
+    if args.format == 'npz':
+        writer = lhe_stream.ThreadedWriter(lhe_stream.WeightSidecarWriter(args.output, GetNumPoints(len(GetConfigFile(os.path.join(args.module, 'config.json'))['parameters'])), active, os.path.abspath(args.input), resume_offset))
+    else:
+        writer = lhe_stream.ThreadedWriter(lhe_stream.LHEWriter(args.output, resume_offset))
+        if resume_offset is None:
+            writer.Write(reader.header)
+            writer.Write(reader.InitBlock([(name, 'from param_card_%i.dat' % iw) for name, iw in zip(wt_names, active)]))
+
+    def Checkpoint(out_writer, state):
+        # Called from the writer thread, once all events up to this point are written
+        out_writer.Sync()
+        state['output_offset'] = out_writer.offset
+        WriteCheckpoint(checkpoint_file, state)
+
+    last_checkpoint = start_time = time.time()
+    # Events are read in windows, which are split into chunks for the worker processes
+    # in --workers mode. The results are written out in the original event order.
+    # The transformed weights are also stored in the npz output
+    transform = args.validate or args.format == 'npz'
+    for events in lhe_stream.ThreadedReader(reader, window):
+        neve += len(events)
+        infos = [event.Info() for event in events]
+        if pool is None:
+            weights, trans_weights = ReweightEvents(rw, infos, bool(args.helicity), transform)
+        else:
+            chunks = [(infos[i:i + args.chunk_size], bool(args.helicity), transform) for i in range(0, len(infos), args.chunk_size)]
+            results = []
+            for chunk_results, chunk_monitor in pool.map(ReweightChunk, chunks):
+                results.append(chunk_results)
+                monitor.Merge(chunk_monitor)
+            weights = numpy.concatenate([res for res, trans_res in results])
+            trans_weights = numpy.concatenate([trans_res for res, trans_res in results]) if transform else None
+
+        out = []
+        for ie, (event, res) in enumerate(zip(events, weights)):
+            if args.validate:
+                existing = [wt for name, wt in event.Weights()]
+                print('>> Reading %i existing weights' % len(existing))
+                for iw in [X for X in active if X < len(existing)]:
+                    print('%-10f %-10f %-10f | %-10f' % (existing[iw] / existing[0], res[iw], res[iw] / (existing[iw] / existing[0]), trans_weights[ie, iw]))
+            if args.format == 'lhe':
+                out.append(event.Text(wt_names, [res[iw] * event.xwgtup for iw in active]))
+        if args.format == 'npz':
+            out = (weights, trans_weights,
+                   [event.xwgtup for event in events], [event.offset for event in events])
+        else:
+            out = ''.join(out)
+        callback = None
+        if args.checkpoint_interval > 0 and time.time() - last_checkpoint >= args.checkpoint_interval:
+            state = {'input': os.path.abspath(args.input), 'input_offset': events[-1].offset, 'events': neve, 'weights': wt_names}
+            callback = lambda out_writer, state=state: Checkpoint(out_writer, state)
+            last_checkpoint = time.time()
+        writer.Write(out, callback)
+
+    writer.Close()
+    reader.Close()
+    monitor.PrintCounters()
+    if args.timing_json is not None:
+        summary = monitor.Summary()
+        summary['events'] = neve
+        summary['wall_time'] = time.time() - start_time
+        with open(args.timing_json, 'w') as outfile:
+            json.dump(summary, outfile, indent=2)
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    RemoveStaleCheckpoints(checkpoint_file)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        session.__exit__(None, None, None)